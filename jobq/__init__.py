@@ -1,6 +1,13 @@
 from .jobq import (
+    CancelToken,
+    Cancelled,
     EmptyRst,
     Finish,
+    Merge,
+    Pipeline,
+    imap,
     run,
+    run_dag,
     stat,
+    Timeout,
 )
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Benchmark jobq.run: elements per second and per-element overhead.
+#
+# Every case changes one dimension of the base case:
+# number of stages, number of threads, generator-returning worker, payload
+# size and chunk. keep_order is crossed with 4 and 16 threads, with a single
+# thread there is nothing to reorder.
+#
+#   cd jobq
+#   python -m bench.bench_jobq --output base.json
+#   # change something
+#   python -m bench.bench_jobq --output new.json --compare base.json
+
+import argparse
+import itertools
+import json
+import platform
+import subprocess
+import sys
+import time
+
+import jobq
+
+base_case = {
+    'stages': 2,
+    'threads': 1,
+    'keep_order': False,
+    'generator': 0,
+    'payload': 0,
+    'chunk': None,
+}
+
+dimensions = (
+    ('stages', (1, 2, 4, 8)),
+    ('threads', (1, 4, 16)),
+    # number of elements yielded by the generator worker of each stage.
+    ('generator', (0, 1, 4)),
+    # bytes of every element, 0 for an int
+    ('payload', (0, 1024, 64 * 1024)),
+    ('chunk', (None, 16, 256)),
+)
+
+# dimensions changed together, every combination of their values is a case.
+crossed = (
+    (('keep_order', (False, True)), ('threads', (4, 16))),
+)
+
+
+def identity(args):
+    return args
+
+
+def make_gen_worker(nr):
+
+    def gen_worker(args):
+        for ii in range(nr):
+            yield args
+
+    return gen_worker
+
+
+def make_input(nr_items, payload):
+
+    if payload == 0:
+        return range(nr_items)
+
+    elt = b'x' * payload
+    return (elt for ii in range(nr_items))
+
+
+def run_case(case, nr_items, repeat):
+
+    # returns the best seconds spent in `repeat` runs.
+
+    if case['generator'] > 0:
+        worker = make_gen_worker(case['generator'])
+    else:
+        worker = identity
+
+    workers = [(worker, case['threads'])] * case['stages']
+
+    best = None
+    for ii in range(repeat):
+
+        t0 = time.time()
+        jobq.run(make_input(nr_items, case['payload']), workers,
+                 keep_order=case['keep_order'], chunk=case['chunk'])
+        spent = time.time() - t0
+
+        if best is None or spent < best:
+            best = spent
+
+    return best
+
+
+def case_name(case):
+    return ','.join(['{0}={1}'.format(k, case[k]) for k in sorted(case)])
+
+
+def changes():
+
+    # yields dicts of dimensions to change in base_case.
+
+    for key, values in dimensions:
+        for val in values:
+            yield {key: val}
+
+    for dims in crossed:
+        keys = [k for k, _ in dims]
+        for vals in itertools.product(*[v for _, v in dims]):
+            yield dict(zip(keys, vals))
+
+
+def cases():
+
+    seen = set()
+    for change in changes():
+
+        case = dict(base_case)
+        case.update(change)
+
+        name = case_name(case)
+        if name in seen:
+            continue
+        seen.add(name)
+
+        yield case
+
+
+def git_commit():
+
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                      stderr=subprocess.STDOUT)
+        return out.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench(nr_items, repeat):
+
+    results = []
+    for case in cases():
+
+        spent = run_case(case, nr_items, repeat)
+
+        # generator workers multiply elements in every stage but the last
+        # one(_blackhole) does not.
+        elts_per_stage = [nr_items * max(case['generator'], 1) ** ii
+                          for ii in range(case['stages'])]
+        nr_calls = sum(elts_per_stage)
+
+        rst = {'name': case_name(case),
+               'case': case,
+               'items': nr_items,
+               'seconds': spent,
+               'items_per_second': nr_items / spent,
+               'us_per_item_per_stage': spent * 1000 * 1000 / nr_calls,
+               }
+        results.append(rst)
+
+        sys.stderr.write('{name:<60} {items_per_second:>10.0f}/s'
+                         ' {us_per_item_per_stage:>8.2f}us\n'.format(**rst))
+
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'commit': git_commit(),
+            'time': time.time(),
+            'items': nr_items,
+            'repeat': repeat,
+            'results': results,
+            }
+
+
+def compare(new, base, threshold):
+
+    # returns number of regressions
+
+    base_results = dict([(x['name'], x) for x in base['results']])
+
+    nr_regression = 0
+    print('{0:<60} {1:>10} {2:>10} {3:>7}'.format(
+        'case', 'base/s', 'new/s', 'ratio'))
+
+    for rst in new['results']:
+
+        b = base_results.get(rst['name'])
+        if b is None:
+            continue
+
+        ratio = rst['items_per_second'] / b['items_per_second']
+        mark = ''
+        if ratio < 1 - threshold:
+            mark = ' REGRESSION'
+            nr_regression += 1
+
+        print('{0:<60} {1:>10.0f} {2:>10.0f} {3:>7.2f}{4}'.format(
+            rst['name'], b['items_per_second'], rst['items_per_second'],
+            ratio, mark))
+
+    return nr_regression
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='benchmark jobq.run')
+    parser.add_argument('--items', type=int, default=20000,
+                        help='number of input elements of every run')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='run every case this many times, keep the best')
+    parser.add_argument('--output', help='write results in json to file')
+    parser.add_argument('--compare',
+                        help='json file of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slow down ratio reported as regression')
+    args = parser.parse_args()
+
+    rst = bench(args.items, args.repeat)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(rst, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(rst, indent=2, sort_keys=True))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            base = json.load(f)
+
+        if compare(rst, base, args.threshold) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
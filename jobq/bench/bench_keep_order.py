@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Compare throughput of a stage with keep_order=True and keep_order=False.
+#
+#   cd jobq && python -m bench.bench_keep_order
+
+import time
+
+import jobq
+
+
+def cheap(args):
+    return args
+
+
+def io_wait(args):
+    # most calls are fast, some are 10 times slower
+    if args % 50 == 0:
+        time.sleep(0.01)
+    else:
+        time.sleep(0.001)
+    return args
+
+
+def bench(worker, nr_items, n, keep_order):
+
+    t0 = time.time()
+    jobq.run(range(nr_items), [(worker, n)], keep_order=keep_order)
+    spent = time.time() - t0
+
+    return nr_items / spent
+
+
+def main():
+
+    print('{0:<8} {1:>3} {2:>14} {3:>14} {4:>7}'.format(
+        'worker', 'n', 'unordered/s', 'ordered/s', 'ratio'))
+
+    for worker, nr_items in ((cheap, 100000), (io_wait, 5000)):
+        for n in (1, 4, 16, 64):
+
+            unordered = bench(worker, nr_items, n, False)
+            ordered = bench(worker, nr_items, n, True)
+
+            print('{0:<8} {1:>3} {2:>14.0f} {3:>14.0f} {4:>7.2f}'.format(
+                worker.__name__, n, unordered, ordered, ordered / unordered))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,161 +1,2729 @@
+import collections
+import heapq
+import inspect
+import itertools
 import logging
+import math
+import multiprocessing
+import os
 import sys
+import tempfile
 import threading
 import time
 import types
 
 if sys.version_info[0] == 2:
+    import cPickle as pickle
     import Queue
 else:
+    import pickle
     import queue as Queue
 
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
 logger = logging.getLogger(__name__)
 
 
-class EmptyRst(object):
-    pass
+class EmptyRst(object):
+    pass
+
+
+class Finish(object):
+    pass
+
+
+class Cancelled(Exception):
+    # raised by jobq.imap when it is stopped by `cancel`.
+    pass
+
+
+class Timeout(Exception):
+    # raised by jobq.imap when `timeout` is reached.
+    pass
+
+
+class CancelToken(object):
+
+    # Pass it to jobq.run to stop it from another thread.
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        # stop events of running jobs, set when cancelled.
+        self.listeners = set()
+
+    def cancel(self):
+        with self.lock:
+            self.event.set()
+            for ev in self.listeners:
+                ev.set()
+
+    def is_cancelled(self):
+        return self.event.is_set()
+
+    def _listen(self, ev):
+        with self.lock:
+            if self.event.is_set():
+                ev.set()
+            self.listeners.add(ev)
+
+    def _unlisten(self, ev):
+        with self.lock:
+            self.listeners.discard(ev)
+
+
+class _Shrink(object):
+    # sent to a stage to make one of its threads quit.
+    pass
+
+
+class _Retry(object):
+
+    # A failed element put back to the input queue of its stage.
+    # `seq` is the sequence number in an ordered stage, the element keeps its
+    # position in output.
+
+    def __init__(self, args, tries, seq):
+        self.args = args
+        self.tries = tries
+        self.seq = seq
+
+
+class _RetryScheduler(object):
+
+    # Put failed elements back to input queue when their backoff time is
+    # reached, so that worker threads do not sleep.
+
+    def __init__(self, inq):
+        self.inq = inq
+        self.heap = []
+        self.counter = itertools.count()
+        self.stopped = False
+        self.cond = threading.Condition()
+
+    def add(self, elt, delay):
+        with self.cond:
+            heapq.heappush(self.heap,
+                           (time.time() + delay, next(self.counter), elt))
+            self.cond.notify()
+
+    def run(self):
+
+        while True:
+
+            with self.cond:
+
+                while not self.stopped:
+                    if len(self.heap) == 0:
+                        self.cond.wait()
+                        continue
+
+                    wait = self.heap[0][0] - time.time()
+                    if wait <= 0:
+                        break
+                    self.cond.wait(wait)
+
+                if self.stopped:
+                    return
+
+                _, _, elt = heapq.heappop(self.heap)
+
+            self.inq.put(elt)
+            # the failed element is done when its retry is queued.
+            self.inq.task_done()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def drain(self):
+        with self.cond:
+            nr = len(self.heap)
+            self.heap = []
+            return nr
+
+    def qsize(self):
+        return len(self.heap)
+
+
+class _RateLimiter(object):
+
+    # A token bucket shared by all threads of a stage. `rate` tokens are
+    # added every second, at most `burst` are kept.
+    # A thread takes tokens at once, even if it leaves the bucket in debt,
+    # and sleeps until the debt is paid. Thus threads are served in the
+    # order they ask.
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, nr):
+
+        # returns seconds to wait before using `nr` tokens.
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+            self.tokens -= nr
+            if self.tokens >= 0:
+                return 0
+
+            return -self.tokens / self.rate
+
+
+class _Cache(object):
+
+    # LRU cache of worker results, an entry expires `ttl` seconds after it
+    # is added. An element whose key is being processed by another thread
+    # waits for the result instead of calling the worker again.
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        # key -> (expire time, is generator, result)
+        self.entries = collections.OrderedDict()
+        # key -> Event set when the call finishes
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+        self.hit = 0
+        self.miss = 0
+        self.dedup = 0
+
+    def call(self, call, key, args):
+
+        while True:
+
+            with self.lock:
+
+                ent = self.entries.pop(key, None)
+                if ent is not None and ent[0] > time.time():
+                    # most recently used at the end
+                    self.entries[key] = ent
+                    self.hit += 1
+                    return _cached_rst(ent)
+
+                ev = self.inflight.get(key)
+                if ev is None:
+                    self.miss += 1
+                    ev = self.inflight[key] = threading.Event()
+                    break
+
+                self.dedup += 1
+
+            # the result is cached when it is set, unless the call failed,
+            # then this thread calls it.
+            ev.wait()
+
+        try:
+            rst = call(args)
+            is_gen = type(rst) == types.GeneratorType
+            if is_gen:
+                rst = list(rst)
+
+            with self.lock:
+                self.entries[key] = (time.time() + self.ttl, is_gen, rst)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+
+            return _cached_rst((None, is_gen, rst))
+
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            ev.set()
+
+    def stat(self):
+        with self.lock:
+            nr = self.hit + self.miss
+            return {'size': len(self.entries),
+                    'capa': self.size,
+                    'hit': self.hit,
+                    'miss': self.miss,
+                    'dedup': self.dedup,
+                    'hit_ratio': self.hit * 1.0 / nr if nr > 0 else None,
+                    }
+
+
+def _cached_rst(ent):
+    # a generator result is cached as a list, every element gets a new
+    # generator of it.
+    _, is_gen, rst = ent
+    if is_gen:
+        return (rr for rr in rst)
+    return rst
+
+
+AUTOSCALE_INTERVAL = 0.1
+
+# interval to check cancellation when blocking on a queue.
+CANCEL_CHECK_INTERVAL = 0.1
+
+# max number of results an ordered stage buffers ahead of the oldest
+# unfinished element.
+REORDER_WINDOW = 1024
+
+# seconds of history used to calculate items per second.
+RATE_WINDOW = 10
+
+# max seconds an element waits in a partial chunk before it is sent.
+CHUNK_FLUSH_INTERVAL = 0.01
+
+# seconds between checkpoints of input journal. At a checkpoint, input
+# is paused until all elements fed are processed.
+JOURNAL_INTERVAL = 10
+
+# a spill segment file is not appended to after it reaches this size, and it
+# is removed once all of its elements are read.
+SPILL_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# upper bounds of worker call latency histogram buckets, powers of 2 from
+# about 1 us to 128 seconds. The bucket of a call is the integer log2 of its
+# latency, by math.frexp().
+LATENCY_MIN_EXP = -20
+LATENCY_BOUNDS = [2.0 ** e for e in range(LATENCY_MIN_EXP, 8)]
+
+
+class _SeqQueue(Queue.Queue):
+
+    # A queue that numbers elements in the order they are put.
+    # A thread of an ordered stage finds out, without any extra lock, the
+    # sequence numbers of the elements it got with pop_seqs().
+
+    def _init(self, maxsize):
+        Queue.Queue._init(self, maxsize)
+        self.seq = 0
+        self.got = threading.local()
+
+    def _put(self, item):
+        if isinstance(item, _Retry) and item.seq is not None:
+            self.queue.append((item.seq, item))
+            return
+
+        self.queue.append((self.seq, item))
+        self.seq += 1
+
+    def _get(self):
+        seq, item = self.queue.popleft()
+        try:
+            self.got.seqs.append(seq)
+        except AttributeError:
+            self.got.seqs = [seq]
+
+        return item
+
+    def pop_seqs(self):
+        seqs = getattr(self.got, 'seqs', [])
+        self.got.seqs = []
+        return seqs
+
+
+class _Chunk(list):
+    pass
+
+
+# per thread: queue -> [time to send, partial _Chunk] of
+# elements put, and queue -> deque of elements of the last chunk got.
+_chunk_local = threading.local()
+
+
+class _ChunkQueue(Queue.Queue):
+
+    # A queue that transfers elements between threads in chunks, to lock it
+    # once for up to `chunk` elements.
+    # Elements put by a thread are buffered and sent as a chunk when it is
+    # full, when it is older than CHUNK_FLUSH_INTERVAL or when the thread is
+    # about to wait for input. A thread gets a chunk and returns its elements
+    # one by one.
+    # A thread takes at most its share, queued elements / `consumers`, of a
+    # chunk, and leaves the rest to other threads of the stage.
+    # Sentinels and retried elements are never buffered. maxsize is in
+    # number of chunks, qsize() in number of elements.
+
+    def __init__(self, maxsize, chunk):
+        self.chunk = chunk
+        # number of threads getting from it
+        self.consumers = 1
+        Queue.Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        Queue.Queue._init(self, maxsize)
+        self.nr_elts = 0
+        # id -> partial chunk of all threads, to find out if any element is
+        # still buffered.
+        self.partial = {}
+
+    def _put(self, item):
+        self.queue.append(item)
+        if isinstance(item, _Chunk):
+            self.nr_elts += len(item)
+            # task_done() is called once for every element.
+            self.unfinished_tasks += len(item) - 1
+        else:
+            self.nr_elts += 1
+
+    def _get(self):
+
+        item = self.queue.popleft()
+        if not isinstance(item, _Chunk):
+            self.nr_elts -= 1
+            return item
+
+        share = -(-self.nr_elts // self.consumers)
+        if len(item) > share:
+            # put the rest back to the head and wake up another thread.
+            self.queue.appendleft(_Chunk(item[share:]))
+            item = _Chunk(item[:share])
+            self.not_empty.notify()
+
+        self.nr_elts -= len(item)
+        return item
+
+    def qsize(self):
+        with self.mutex:
+            return self.nr_elts
+
+    def put(self, item, block=True, timeout=None):
+
+        if item is Finish or item is _Shrink or isinstance(item, _Retry):
+            self.flush()
+            Queue.Queue.put(self, item, block, timeout)
+            return
+
+        bufs = _chunk_bufs()
+        buf = bufs.get(self)
+
+        if buf is not None and len(buf[1]) >= self.chunk:
+            # item is not taken if it raises Full.
+            self._put_chunk(bufs, block, timeout)
+            buf = None
+
+        if buf is None:
+            buf = bufs[self] = [time.time() + CHUNK_FLUSH_INTERVAL, _Chunk()]
+            self.partial[id(buf[1])] = buf[1]
+
+        chunk = buf[1]
+        chunk.append(item)
+
+        if len(chunk) >= self.chunk or time.time() >= buf[0]:
+            try:
+                self._put_chunk(bufs, block, timeout)
+            except Queue.Full:
+                # item is taken, the chunk is sent by the next put.
+                pass
+
+    def _put_chunk(self, bufs, block, timeout):
+        chunk = bufs[self][1]
+        Queue.Queue.put(self, chunk, block, timeout)
+        del bufs[self]
+        del self.partial[id(chunk)]
+
+    def flush(self):
+        bufs = _chunk_bufs()
+        if self in bufs:
+            self._put_chunk(bufs, True, None)
+
+    def get(self, block=True, timeout=None):
+
+        pending = _chunk_pending()
+        elts = pending.get(self)
+        if elts:
+            return elts.popleft()
+
+        try:
+            item = Queue.Queue.get(self, False)
+        except Queue.Empty:
+            if not block:
+                raise
+            # do not keep downstream waiting for what this thread buffered.
+            _flush_chunks()
+            item = Queue.Queue.get(self, True, timeout)
+
+        if isinstance(item, _Chunk):
+            elts = collections.deque(item)
+            item = elts.popleft()
+            if len(elts) > 0:
+                pending[self] = elts
+            elif self in pending:
+                del pending[self]
+
+        elif item is Finish or item is _Shrink:
+            # the thread is going to quit.
+            pending.pop(self, None)
+            _flush_chunks()
+
+        return item
+
+
+def _chunk_bufs():
+    try:
+        return _chunk_local.bufs
+    except AttributeError:
+        _chunk_local.bufs = {}
+        return _chunk_local.bufs
+
+
+def _chunk_pending():
+    try:
+        return _chunk_local.pending
+    except AttributeError:
+        _chunk_local.pending = {}
+        return _chunk_local.pending
+
+
+def _flush_chunks():
+    # send all partial chunks buffered by the current thread.
+    for q in list(_chunk_bufs().keys()):
+        q.flush()
+
+
+class _PartitionQueue(object):
+
+    # Input of a stage with 'partition_key': one queue for every thread.
+    # Elements with the same key go to the same queue and are processed in
+    # order by the same thread.
+    # It tracks unfinished elements for all partitions like a Queue does.
+    # An element key_func raises for is passed to on_key_error and not
+    # queued.
+
+    def __init__(self, maxsize, key_func, n):
+        self.key_func = key_func
+        self.on_key_error = None
+        self.parts = [Queue.Queue(maxsize) for ii in range(n)]
+        self.maxsize = maxsize * n
+
+        self.mutex = threading.Lock()
+        self.all_tasks_done = threading.Condition(self.mutex)
+        self.unfinished_tasks = 0
+
+        # index of partition a thread gets from
+        self.local = threading.local()
+        self.nr_bound = 0
+        # sentinels are put to partitions in turn, one for every thread.
+        self.nr_sentinel = 0
+
+    def bind(self):
+        # called by a thread before it gets from this queue.
+        with self.mutex:
+            self.local.part = self.parts[self.nr_bound]
+            self.nr_bound += 1
+
+    def put(self, item, block=True, timeout=None):
+
+        if item is Finish or item is _Shrink:
+            # a thread puts back Finish to its own partition.
+            part = getattr(self.local, 'part', None)
+            if part is None:
+                with self.mutex:
+                    part = self.parts[self.nr_sentinel % len(self.parts)]
+                    self.nr_sentinel += 1
+        else:
+            try:
+                if isinstance(item, _Retry):
+                    key = self.key_func(item.args)
+                else:
+                    key = self.key_func(item)
+                idx = hash(key) % len(self.parts)
+            except Exception as e:
+                if self.on_key_error is None:
+                    raise
+                self.on_key_error(item, e)
+                return
+
+            part = self.parts[idx]
+
+        # count it before it is seen by the thread.
+        with self.mutex:
+            self.unfinished_tasks += 1
+
+        try:
+            part.put(item, block, timeout)
+        except Queue.Full:
+            self.task_done()
+            raise
+
+    def get(self, block=True, timeout=None):
+
+        part = getattr(self.local, 'part', None)
+        if part is not None:
+            return part.get(block, timeout)
+
+        # a thread not bound, such as the one draining queues when
+        # cancelled, takes from any partition.
+        for part in self.parts:
+            try:
+                return part.get(block=False)
+            except Queue.Empty:
+                pass
+
+        raise Queue.Empty()
+
+    def task_done(self):
+        with self.mutex:
+            self.unfinished_tasks -= 1
+            if self.unfinished_tasks == 0:
+                self.all_tasks_done.notify_all()
+
+    def qsize(self):
+        return sum([part.qsize() for part in self.parts])
+
+
+class _InMemory(object):
+
+    # written to a spill segment in place of an element that can not be
+    # pickled.
+
+    def __init__(self, key):
+        self.key = key
+
+
+class _SpillDeque(object):
+
+    # Storage of a queue that keeps at most `window` elements in memory.
+    # More elements are pickled to append-only segment files in directory
+    # `path` and read back in order.
+    # Elements that can not be pickled are kept in memory, and a placeholder
+    # is written in their place to keep the order.
+
+    def __init__(self, path, window):
+        self.path = path
+        self.window = window
+        self.mem = collections.deque()
+        self.segments = collections.deque()
+        self.nr_spilled = 0
+        # key -> element that can not be pickled
+        self.held = {}
+        self.next_key = 0
+
+    def __len__(self):
+        return len(self.mem) + self.nr_spilled
+
+    def append(self, item):
+
+        if self.nr_spilled == 0 and len(self.mem) < self.window:
+            self.mem.append(item)
+            return
+
+        try:
+            data = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logger.info('keep element in memory: ' + repr(e))
+            self.held[self.next_key] = item
+            data = pickle.dumps(_InMemory(self.next_key),
+                                pickle.HIGHEST_PROTOCOL)
+            self.next_key += 1
+
+        if (len(self.segments) == 0
+                or self.segments[-1]['size'] >= SPILL_SEGMENT_SIZE):
+            self._new_segment()
+
+        seg = self.segments[-1]
+        seg['writer'].write(data)
+        seg['size'] += len(data)
+        seg['nr'] += 1
+        self.nr_spilled += 1
+
+    def appendleft(self, item):
+        # an element taken is put back to the head.
+        self.mem.appendleft(item)
+
+    def popleft(self):
+
+        if self.nr_spilled == 0 or len(self.mem) > 0:
+            return self.mem.popleft()
+
+        seg = self.segments[0]
+        # the last segment is being written.
+        seg['writer'].flush()
+        item = pickle.load(seg['reader'])
+        if isinstance(item, _InMemory):
+            item = self.held.pop(item.key)
+
+        seg['nr'] -= 1
+        self.nr_spilled -= 1
+
+        if seg['nr'] == 0:
+            self._remove_segment(self.segments.popleft())
+
+        return item
+
+    def _new_segment(self):
+
+        fd, fn = tempfile.mkstemp(prefix='jobq-spill-', dir=self.path)
+        self.segments.append({'fn': fn,
+                              'writer': os.fdopen(fd, 'wb'),
+                              'reader': open(fn, 'rb'),
+                              'size': 0,
+                              'nr': 0,
+                              })
+
+    def _remove_segment(self, seg):
+        seg['writer'].close()
+        seg['reader'].close()
+        os.remove(seg['fn'])
+
+    def close(self):
+        # remove all segment files.
+        while len(self.segments) > 0:
+            self._remove_segment(self.segments.popleft())
+        self.nr_spilled = 0
+        self.held.clear()
+
+
+class _ReorderBuffer(object):
+
+    # Results of an ordered stage indexed by sequence number.
+    # The coordinator takes them out in order. Threads wait for room if they
+    # are more than `maxsize` elements ahead of the coordinator.
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.rsts = {}
+        self.next_seq = 0
+        self.closed = False
+        # number of elements waiting to be retried. Threads must not wait
+        # for room, or no one would process the retried elements.
+        self.held = 0
+        # number of results put and not yet output by the coordinator.
+        self.unfinished = 0
+
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.room = threading.Condition(self.lock)
+        self.all_done = threading.Condition(self.lock)
+
+    def put(self, seq, rst, block=True):
+
+        with self.lock:
+
+            while (block and not self.closed and self.held == 0
+                   and seq >= self.next_seq + self.maxsize):
+                self.room.wait()
+
+            self.rsts[seq] = rst
+            self.unfinished += 1
+
+            if seq == self.next_seq:
+                self.ready.notify()
+
+    def get(self, block=True):
+
+        # return all results ready in order, or Finish.
+        # Without block it returns an empty list if none is ready.
+
+        with self.lock:
+
+            while self.next_seq not in self.rsts:
+                if self.closed:
+                    return Finish
+                if not block:
+                    return []
+                self.ready.wait()
+
+            rsts = []
+            while self.next_seq in self.rsts:
+                rsts.append(self.rsts.pop(self.next_seq))
+                self.next_seq += 1
+
+            self.room.notify_all()
+
+            return rsts
+
+    def task_done(self, nr):
+        # the coordinator output `nr` results.
+        with self.lock:
+            self.unfinished -= nr
+            if self.unfinished == 0:
+                self.all_done.notify_all()
+
+    def wait_done(self, timeout):
+        with self.lock:
+            if self.unfinished > 0:
+                self.all_done.wait(timeout)
+            return self.unfinished == 0
+
+    def hold(self, delta):
+        with self.lock:
+            self.held += delta
+            self.room.notify_all()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.ready.notify()
+            self.room.notify_all()
+
+    def qsize(self):
+        return len(self.rsts)
+
+
+class _Router(object):
+
+    # Output of a stage with more than one downstream stage.
+    # 'broadcast' puts every element to all of them, ('hash', key_func) puts
+    # an element to one of them chosen by hash of key_func(element).
+
+    def __init__(self, queues, route):
+        self.queues = queues
+        self.route = route
+        # an element key_func raises for is passed to it and not delivered.
+        self.on_key_error = None
+
+    def put(self, val):
+        for q in self.targets(val):
+            q.put(val)
+
+    def targets(self, val):
+
+        if self.route == 'broadcast':
+            return self.queues
+
+        _, key_func = self.route
+        try:
+            idx = hash(key_func(val)) % len(self.queues)
+        except Exception as e:
+            if self.on_key_error is None:
+                raise
+            self.on_key_error(val, e)
+            return []
+
+        return [self.queues[idx]]
+
+
+class _NullQueue(object):
+
+    # Output of a stage without downstream stage.
+
+    def put(self, val):
+        pass
+
+    def targets(self, val):
+        return []
+
+
+def run(input_it, workers, keep_order=False, timeout=None, probe=None,
+        cancel=None, chunk=None, journal=None, resume=False, prefetch=1024,
+        fuse=False):
+
+    ctl = _new_ctl(timeout, cancel)
+    _check_journal(journal, resume, input_it)
+    _check_prefetch(prefetch)
+
+    # a bad journal fails before any thread is started.
+    _open_journal(ctl, journal, resume)
+
+    sessions, head_q, outq = _start_pipeline(workers + [_blackhole],
+                                             keep_order, probe, ctl,
+                                             chunk=chunk, in_size=prefetch,
+                                             fuse=fuse)
+
+    _produce(head_q, input_it, ctl, sessions)
+    _stop_pipeline(sessions, ctl)
+    _close_journal(ctl)
+    _release_ctl(ctl)
+    _raise_input_error(ctl)
+
+    # elements arrived at _blackhole are completed.
+    return _summary(sessions, [sessions[-1]], 'in', ctl)
+
+
+def imap(input_it, workers, keep_order=False, timeout=None, probe=None,
+         bufsize=1024, cancel=None, chunk=None, prefetch=1024, fuse=False):
+
+    ctl = _new_ctl(timeout, cancel)
+    _check_prefetch(prefetch)
+
+    # at most `bufsize` results are buffered if the caller does not consume
+    # them fast enough, upstream jobs block then.
+    sessions, head_q, outq = _start_pipeline(workers, keep_order, probe, ctl,
+                                             out_size=bufsize, chunk=chunk,
+                                             in_size=prefetch, fuse=fuse)
+
+    # results not consumed are dropped if cancelled
+    ctl['result_q'] = outq
+
+    def _produce_and_stop():
+        _feed(head_q, input_it, ctl)
+        _stop_pipeline(sessions, ctl)
+        _put_until_stopped(outq, Finish, ctl)
+        _release_ctl(ctl)
+
+    _thread(_produce_and_stop, ())
+
+    def _iter_rst():
+
+        finished = False
+        try:
+            while not _is_stopped(ctl):
+
+                try:
+                    rst = outq.get(timeout=CANCEL_CHECK_INTERVAL)
+                except Queue.Empty:
+                    continue
+
+                if rst is Finish:
+                    finished = True
+                    _raise_input_error(ctl)
+                    if ctl['stopped']:
+                        _raise_stopped(ctl)
+                    return
+                yield rst
+
+            # results are incomplete.
+            _raise_stopped(ctl)
+
+        finally:
+            if not finished:
+                # the caller stopped iterating. The token of the caller is
+                # left untouched.
+                ctl['stop'].set()
+
+    return _iter_rst()
+
+
+def run_dag(input_it, stages, keep_order=False, timeout=None, probe=None,
+            route='broadcast', cancel=None, chunk=None, journal=None,
+            resume=False, prefetch=1024):
+
+    ctl = _new_ctl(timeout, cancel)
+
+    _check_route(route)
+    _check_chunk(chunk)
+    _check_journal(journal, resume, input_it)
+    _check_prefetch(prefetch)
+    stages = _sort_stages(stages)
+
+    if probe is None:
+        probe = {}
+    sessions = []
+    probe['sessions'] = sessions
+
+    specs = [_parse_worker(stg['worker']) for stg in stages]
+    _set_ordered(specs, keep_order)
+
+    # stages without upstream read input with read-ahead of `prefetch`.
+    inqs = dict([(stg['name'],
+                  _make_inq(spec, chunk,
+                            prefetch if len(stg['inputs']) == 0 else 1024))
+                 for stg, spec in zip(stages, specs)])
+
+    # stages without upstream read from input_it
+    head_q = _make_output([inqs[stg['name']] for stg in stages
+                           if len(stg['inputs']) == 0],
+                          route)
+
+    # a bad journal fails before any process or thread is started.
+    _open_journal(ctl, journal, resume)
+
+    # fork worker processes before any thread is started.
+    pools = [multiprocessing.Pool(spec['max_n'])
+             if spec['executor'] == 'process' else None
+             for spec in specs]
+
+    for stg, spec, pool in zip(stages, specs, pools):
+
+        outq = _make_output([inqs[down['name']] for down in stages
+                             if stg['name'] in down['inputs']],
+                            stg['route'])
+
+        sess = _start_sess(spec, pool, inqs[stg['name']], outq, keep_order,
+                           ctl)
+        sess['stage'] = stg['name']
+        sess['is_sink'] = isinstance(outq, _NullQueue)
+
+        sessions.append(sess)
+
+    _produce(head_q, input_it, ctl, sessions)
+
+    # stages are in topological order, a stage receives Finish after all of
+    # its upstream stages finished.
+    _stop_pipeline(sessions, ctl)
+    _close_journal(ctl)
+    _release_ctl(ctl)
+    _raise_input_error(ctl)
+
+    # elements output by stages without downstream are completed.
+    return _summary(sessions, [x for x in sessions if x['is_sink']], 'out',
+                    ctl)
+
+
+class Pipeline(object):
+
+    # Jobs started once and fed by many submit() and wait().
+    #
+    #   p = jobq.Pipeline([add1, (multi2, 4), printarg])
+    #   p.submit(range(10))
+    #   p.wait()
+    #   p.close()
+
+    def __init__(self, workers, keep_order=False, probe=None, cancel=None,
+                 chunk=None, fuse=False):
+
+        self.ctl = _new_ctl(None, cancel)
+        # every stage tracks unfinished elements for wait().
+        self.ctl['track_tasks'] = True
+
+        if probe is None:
+            probe = {}
+        self.probe = probe
+
+        self.sessions, self.head_q, _ = _start_pipeline(
+            workers + [_blackhole], keep_order, probe, self.ctl, chunk=chunk,
+            fuse=fuse)
+
+        self.closed = False
+
+    def submit(self, input_it):
+        # returns when all elements are queued, they are processed in
+        # background.
+        self._check_open()
+        _feed(self.head_q, input_it, self.ctl)
+        _raise_input_error(self.ctl)
+
+    def wait(self, timeout=None):
+
+        # wait for all submitted elements to be processed by all jobs.
+        # Returns False if timed out or cancelled.
+
+        self._check_open()
+
+        if timeout is None:
+            deadline = self.ctl['endtime']
+        else:
+            deadline = time.time() + timeout
+
+        return _wait_all_idle(self.sessions, deadline, self.ctl)
+
+    def stat(self):
+        return stat(self.probe)
+
+    def close(self):
+
+        # wait for queued elements and stop all threads.
+        # Returns a summary like jobq.run does.
+
+        self._check_open()
+        self.closed = True
+
+        _stop_pipeline(self.sessions, self.ctl)
+        _release_ctl(self.ctl)
+        return _summary(self.sessions, [self.sessions[-1]], 'in', self.ctl)
+
+    def _check_open(self):
+        if self.closed:
+            raise ValueError('pipeline is closed')
+
+
+def _wait_all_idle(sessions, deadline, ctl):
+
+    # when a stage is idle, all of its output is in the input of the next
+    # stage. Stages are in topological order.
+    for sess in sessions:
+        if not _wait_idle(sess, deadline, ctl):
+            return False
+
+    return True
+
+
+def _wait_idle(sess, deadline, ctl):
+
+    inq = sess['input']
+
+    while len(getattr(inq, 'partial', ())) > 0:
+        # elements buffered by upstream threads are sent soon.
+        if _is_stopped(ctl) or time.time() > deadline:
+            return False
+        time.sleep(0.001)
+
+    with inq.all_tasks_done:
+        while inq.unfinished_tasks > 0:
+            if _is_stopped(ctl) or time.time() > deadline:
+                return False
+            inq.all_tasks_done.wait(min(CANCEL_CHECK_INTERVAL,
+                                        max(deadline - time.time(), 0)))
+
+    if 'reorder' in sess:
+        while not sess['reorder'].wait_done(CANCEL_CHECK_INTERVAL):
+            if _is_stopped(ctl) or time.time() > deadline:
+                return False
+
+    return True
+
+
+def _sort_stages(stages):
+
+    names = [stg['name'] for stg in stages]
+    if len(set(names)) != len(names):
+        raise ValueError('duplicated stage name: ' + repr(names))
+
+    normalized = []
+    for stg in stages:
+
+        inputs = stg.get('inputs') or []
+        if isinstance(inputs, str):
+            inputs = [inputs]
+
+        for up in inputs:
+            if up not in names:
+                raise ValueError('unknown input stage: ' + repr(up))
+
+        route = stg.get('route', 'broadcast')
+        _check_route(route)
+
+        normalized.append({'name': stg['name'],
+                           'worker': stg['worker'],
+                           'inputs': inputs,
+                           'route': route,
+                           })
+
+    rst = []
+    done = set()
+    while len(rst) < len(normalized):
+
+        ready = [stg for stg in normalized
+                 if stg['name'] not in done
+                 and set(stg['inputs']) <= done]
+
+        if len(ready) == 0:
+            raise ValueError('stages have a cycle')
+
+        for stg in ready:
+            rst.append(stg)
+            done.add(stg['name'])
+
+    return rst
+
+
+def _check_route(route):
+    if route == 'broadcast':
+        return
+    if isinstance(route, tuple) and len(route) == 2 and route[0] == 'hash':
+        return
+    raise ValueError('invalid route: ' + repr(route))
+
+
+def _check_chunk(chunk):
+    if chunk is None:
+        return
+    if not isinstance(chunk, int) or chunk < 1:
+        raise ValueError('invalid chunk: ' + repr(chunk))
+
+
+def _make_output(queues, route):
+
+    if len(queues) == 0:
+        return _NullQueue()
+
+    if len(queues) == 1:
+        return queues[0]
+
+    return _Router(queues, route)
+
+
+def _new_ctl(timeout, cancel):
+
+    # 'stop' is the only flag checked per element. It is set by the cancel
+    # token, by the deadline timer, or when imap is closed early.
+
+    ctl = {'endtime': time.time() + (timeout or 86400 * 365),
+           'cancel': cancel or CancelToken(),
+           'stop': threading.Event(),
+           'timer': None,
+           }
+
+    ctl['cancel']._listen(ctl['stop'])
+
+    if timeout:
+        timer = threading.Timer(timeout, ctl['stop'].set)
+        timer.daemon = True
+        timer.start()
+        ctl['timer'] = timer
+
+    return ctl
+
+
+def _release_ctl(ctl):
+
+    # the cancel token may be shared by many runs.
+    if ctl['timer'] is not None:
+        ctl['timer'].cancel()
+    ctl['cancel']._unlisten(ctl['stop'])
+
+
+def _raise_stopped(ctl):
+
+    if ctl['cancel'].is_cancelled():
+        raise Cancelled('jobs are cancelled')
+
+    raise Timeout('jobs are timed out')
+
+
+def _is_stopped(ctl):
+    return ctl['stop'].is_set()
+
+
+class Merge(object):
+
+    # Input of several iterators, each of them is read by a thread of its
+    # own, concurrently.
+    #
+    #   jobq.run(jobq.Merge(it1, it2), [add1, printarg])
+
+    def __init__(self, *iterators):
+        self.iterators = iterators
+
+
+def _produce(head_q, input_it, ctl, sessions):
+
+    # Read input in a thread, then the caller does not wait for a blocking
+    # input_it after it is cancelled or timed out.
+
+    th = _thread(_feed, (head_q, input_it, ctl, sessions))
+    _join_until_stopped(th, ctl)
+
+
+def _feed(head_q, input_it, ctl, sessions=()):
+
+    if isinstance(input_it, Merge):
+        ths = [_thread(_feed, (head_q, it, ctl, sessions))
+               for it in input_it.iterators]
+        for th in ths:
+            if not _join_until_stopped(th, ctl):
+                return
+        return
+
+    try:
+        _feed_it(head_q, input_it, ctl, sessions)
+    except Exception as e:
+        logger.exception(repr(e))
+        # raised to the caller after the elements read are processed.
+        ctl['input_error'] = e
+
+
+def _raise_input_error(ctl):
+    err = ctl.pop('input_error', None)
+    if err is not None:
+        raise err
+
+
+def _feed_it(head_q, input_it, ctl, sessions):
+
+    jnl = ctl.get('journal')
+    if jnl is not None:
+        # skip elements completed by the previous run.
+        input_it = itertools.islice(input_it, jnl['offset'], None)
+
+    for args in input_it:
+        for q in _targets(head_q, args):
+            if not _put_until_stopped(q, args, ctl):
+                return
+
+        if jnl is not None:
+            jnl['offset'] += 1
+            if time.time() >= jnl['next'] and not _checkpoint(sessions, ctl):
+                return
+
+    _flush_chunks()
+
+
+def _check_journal(path, resume, input_it):
+
+    if resume and path is None:
+        raise ValueError('resume requires journal')
+
+    # offset of elements read concurrently from several iterators is
+    # meaningless.
+    if path is not None and isinstance(input_it, Merge):
+        raise ValueError('journal does not support Merge input')
+
+
+def _check_prefetch(prefetch):
+    if not isinstance(prefetch, int) or prefetch < 1:
+        raise ValueError('invalid prefetch: ' + repr(prefetch))
+
+
+def _open_journal(ctl, path, resume):
+
+    # The journal is a file of lines of input offsets. An offset means all
+    # input elements before it are processed by all jobs.
+
+    if path is None:
+        return
+
+    offset = 0
+    if resume and os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                # the last line may be incomplete if the process died.
+                if line.endswith('\n'):
+                    offset = int(line)
+
+    ctl['journal'] = {'file': open(path, 'a' if resume else 'w'),
+                      'offset': offset,
+                      'next': time.time() + JOURNAL_INTERVAL,
+                      }
+    # to find out when all elements fed are processed.
+    ctl['track_tasks'] = True
+
+
+def _checkpoint(sessions, ctl):
+
+    # wait for all elements fed to be processed, then record the offset.
+    # Returns False if it is cancelled or timed out.
+
+    jnl = ctl['journal']
+
+    _flush_chunks()
+    if not _wait_all_idle(sessions, ctl['endtime'], ctl):
+        return False
+
+    _write_journal(jnl)
+    jnl['next'] = time.time() + JOURNAL_INTERVAL
+
+    return True
+
+
+def _write_journal(jnl):
+    f = jnl['file']
+    f.write('{0}\n'.format(jnl['offset']))
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _close_journal(ctl):
+
+    jnl = ctl.get('journal')
+    if jnl is None:
+        return
+
+    # all elements are processed if it is not stopped.
+    if not ctl['stopped']:
+        _write_journal(jnl)
+
+    jnl['file'].close()
+
+
+def _targets(q, val):
+    if isinstance(q, (_Router, _NullQueue)):
+        return q.targets(val)
+    return [q]
+
+
+def _put_until_stopped(q, val, ctl):
+
+    while True:
+        try:
+            q.put(val, timeout=CANCEL_CHECK_INTERVAL)
+            return True
+        except Queue.Full:
+            if _is_stopped(ctl):
+                return False
+
+
+def _summary(sessions, ends, completed_key, ctl):
+
+    stats = stat({'sessions': sessions})
+
+    rst = {'completed': 0,
+           'pending': 0,
+           'dropped': 0,
+           'cancelled': ctl['stopped'],
+           }
+
+    for sess, st in zip(sessions, stats):
+        if sess in ends:
+            rst['completed'] += st[completed_key]
+        rst['pending'] += st['busy']
+        rst['dropped'] += st['dropped']
+
+    return rst
+
+
+def _start_pipeline(workers, keep_order, probe, ctl, out_size=1024,
+                    chunk=None, in_size=1024, fuse=False):
+
+    _check_chunk(chunk)
+
+    if probe is None:
+        probe = {}
+    sessions = []
+    probe['sessions'] = sessions
+
+    specs = [_parse_worker(worker) for worker in workers]
+    _set_ordered(specs, keep_order)
+
+    if len(specs) > 0:
+        head_q = _make_inq(specs[0], chunk, in_size)
+    else:
+        head_q = _make_q(n=in_size, chunk=chunk)
+    inq = head_q
+
+    # fork worker processes before any thread is started.
+    pools = [multiprocessing.Pool(spec['max_n'])
+             if spec['executor'] == 'process' else None
+             for spec in specs]
+
+    # index of the first stage of the fused group every stage belongs to.
+    if fuse:
+        heads = _fuse_heads(specs)
+    else:
+        heads = list(range(len(specs)))
+
+    for ii, (spec, pool) in enumerate(zip(specs, pools)):
+
+        if heads[ii] != ii:
+            # started with the first stage of its group
+            continue
+
+        last = ii
+        while last + 1 < len(specs) and heads[last + 1] == ii:
+            last += 1
+
+        if last < len(specs) - 1:
+            outq = _make_inq(specs[last + 1], chunk)
+        else:
+            outq = _make_q(n=out_size, chunk=chunk)
+
+        fused = [_new_fused_sess(x, ctl) for x in specs[ii + 1:last + 1]]
+        if len(fused) > 0:
+            spec['fused'] = fused
+
+        sess = _start_sess(spec, pool, inq, outq, keep_order, ctl)
+
+        sessions.append(sess)
+        for fsess in fused:
+            fsess['fused_into'] = sess
+            sessions.append(fsess)
+
+        inq = outq
+
+    return sessions, head_q, inq
+
+
+def _fusible(spec):
+    return (spec['n'] == 1
+            and spec['autoscale'] is None
+            and spec['executor'] == 'thread'
+            and spec['batch'] is None
+            and spec['retry'] is None
+            and spec['rate'] is None
+            and spec['partition_key'] is None
+            and spec['spill'] is None
+            and spec['cache'] is None)
+
+
+def _fuse_heads(specs):
+
+    # consecutive plain single-thread stages are run by one thread.
+
+    heads = []
+    for ii, spec in enumerate(specs):
+        if ii > 0 and _fusible(specs[ii - 1]) and _fusible(spec):
+            heads.append(heads[ii - 1])
+        else:
+            heads.append(ii)
+
+    return heads
+
+
+def _new_fused_sess(spec, ctl):
+
+    # A stage called by the thread of the first stage of its group. It has
+    # no thread or input queue of its own, only stats.
+
+    return {'worker': spec['worker'],
+            'executor': spec['executor'],
+            'call': spec['worker'],
+            'threads': [],
+            'input': Queue.Queue(0),
+            'busy': {},
+            'threads_lock': threading.RLock(),
+            # stats of threads calling the job, one for each of them.
+            'stats': [],
+            # stats of other threads, such as the coordinator.
+            'aux_stats': [],
+            'ctl': ctl,
+            'dropped': 0,
+            }
+
+
+def _set_ordered(specs, keep_order):
+
+    # a stage with more than one thread needs a coordinator to keep order.
+    # A partitioned stage keeps order of elements with the same key by
+    # itself.
+    for spec in specs:
+        spec['ordered'] = (keep_order
+                           and spec['max_n'] > 1
+                           and spec['executor'] != 'async'
+                           and spec['partition_key'] is None)
+
+
+def _make_inq(spec, chunk, n=1024):
+
+    if spec['partition_key'] is not None:
+        return _PartitionQueue(n, spec['partition_key'], spec['n'])
+
+    q = _make_q(n=n, ordered=spec['ordered'], chunk=chunk)
+
+    if spec['spill'] is not None:
+        path, window = spec['spill']
+        if chunk is not None:
+            window = max(window // chunk, 2)
+
+        # never full, elements out of window go to disk.
+        q.maxsize = 0
+        q.queue = _SpillDeque(path, window)
+
+    return q
+
+
+def _start_sess(spec, pool, inq, outq, keep_order, ctl):
+
+    worker, n, executor = spec['worker'], spec['n'], spec['executor']
+
+    sess = {'worker': worker,
+            'executor': executor,
+            'call': worker,
+            'threads': [],
+            'input': inq,
+            'busy': {},
+            'threads_lock': threading.RLock(),
+            # stats of threads calling the job, one for each of them.
+            'stats': [],
+            # stats of other threads, such as the coordinator.
+            'aux_stats': [],
+            'ctl': ctl,
+            # elements discarded from input queue when cancelled
+            'dropped': 0,
+            }
+
+    if pool is not None:
+        sess['pool'] = pool
+        sess['call'] = _process_caller(pool, worker)
+
+    if spec['batch'] is not None:
+        sess['batch'] = spec['batch']
+        if executor != 'async':
+            sess['call'] = _batch_caller(sess['call'])
+
+    if spec['cache'] is not None:
+        size, ttl, key_func = spec['cache']
+        sess['cache'] = _Cache(size, ttl or 86400 * 365)
+        sess['call'] = _cache_caller(sess['cache'], sess['call'], key_func)
+
+    if spec['rate'] is not None:
+        sess['rate'] = _RateLimiter(*spec['rate'])
+
+    if spec['partition_key'] is not None:
+        sess['partition_key'] = spec['partition_key']
+        _set_key_error(sess, inq)
+
+    if isinstance(outq, _Router):
+        _set_key_error(sess, outq)
+
+    if spec['spill'] is not None:
+        sess['spill'] = spec['spill']
+
+    if spec['retry'] is not None:
+        sess['retry'] = spec['retry']
+        sess['dead_letter'] = spec['dead_letter']
+        sess['retry_sched'] = _RetryScheduler(inq)
+        sess['retry_th'] = _thread(sess['retry_sched'].run, ())
+
+    if executor == 'async':
+        # a feeder thread submits coroutines to the event loop and the
+        # coordinator thread collects results.
+        sess['loop'] = asyncio.new_event_loop()
+        sess['loop_th'] = _thread(_run_loop, (sess['loop'], ))
+        sess['sema'] = threading.Semaphore(n)
+        sess['concurrency'] = n
+        sess['queue_of_outq'] = _make_q(n=n + 1)
+        sess['coor_th'] = _thread(_collect_async, (sess, outq))
+
+        sess['threads'] = [_thread(_exec_async, (sess, keep_order))]
+
+        return sess
+
+    sess['output'] = outq
+    sess['ordered'] = spec['ordered']
+
+    if 'fused' in spec:
+        sess['fused'] = spec['fused']
+
+    if sess['ordered']:
+        # to maximize concurrency
+        sess['reorder'] = _ReorderBuffer(REORDER_WINDOW)
+        sess['coor_th'] = _thread(_coordinate, (sess, outq))
+
+    for ii in range(n):
+        _add_thread(sess)
+
+    if spec['autoscale'] is not None:
+        _start_autoscale(sess, spec['autoscale'])
+
+    return sess
+
+
+def _stop_pipeline(sessions, ctl):
+
+    ctl['stopped'] = False
+
+    for sess in sessions:
+        if _is_stopped(ctl) or not _stop_sess(sess, ctl):
+            break
+    else:
+        return
+
+    # timed out or cancelled
+    ctl['stopped'] = True
+    _cancel_pipeline(sessions, ctl)
+
+
+def _stop_sess(sess, ctl):
+
+    # returns False if it is cancelled or timed out before all threads quit.
+
+    if 'autoscale' in sess:
+        _stop_autoscale(sess, ctl)
+
+    if 'retry' in sess:
+        # all elements including retries are processed.
+        if not _wait_tasks_done(sess['input'], ctl):
+            return False
+        sess['retry_sched'].stop()
+
+    threads = sess['threads'][:]
+
+    # put nr = len(threads) Finish
+    for th in threads:
+        if not _put_until_stopped(sess['input'], Finish, ctl):
+            return False
+
+    for th in threads:
+        if not _join_until_stopped(th, ctl):
+            return False
+
+    if 'reorder' in sess:
+        sess['reorder'].close()
+
+    elif 'queue_of_outq' in sess:
+        if not _put_until_stopped(sess['queue_of_outq'], Finish, ctl):
+            return False
+
+    if 'coor_th' in sess:
+        if not _join_until_stopped(sess['coor_th'], ctl):
+            return False
+
+    _release_sess(sess)
+
+    return True
+
+
+def _wait_tasks_done(q, ctl):
+
+    with q.all_tasks_done:
+        while q.unfinished_tasks > 0:
+            if _is_stopped(ctl):
+                return False
+            q.all_tasks_done.wait(CANCEL_CHECK_INTERVAL)
+
+    return True
+
+
+def _join_until_stopped(th, ctl):
+
+    while th.is_alive():
+        if _is_stopped(ctl):
+            return False
+        th.join(CANCEL_CHECK_INTERVAL)
+
+    return True
+
+
+def _release_sess(sess):
+
+    if 'pool' in sess:
+        _close_pool(sess)
+
+    if 'spill' in sess:
+        with sess['input'].mutex:
+            sess['input'].queue.close()
+
+    if 'loop' in sess:
+        _close_loop(sess)
+
+    # do not release twice
+    sess.pop('pool', None)
+    sess.pop('loop', None)
+
+
+def _cancel_pipeline(sessions, ctl):
+
+    for sess in sessions:
+
+        if 'autoscale' in sess:
+            sess['autoscale']['stop'].set()
+
+        # wake up threads waiting for room in reorder buffer
+        if 'reorder' in sess:
+            sess['reorder'].close()
+
+        if 'retry' in sess:
+            sess['retry_sched'].stop()
+            sess['dropped'] += sess['retry_sched'].drain()
+
+    # drop queued elements at once so that the summary includes them, then
+    # keep draining in background until all threads quit.
+    _drain_pipeline(sessions, ctl)
+    _thread(_reap, (sessions, ctl))
+
+
+def _reap(sessions, ctl):
+
+    while _drain_pipeline(sessions, ctl):
+        time.sleep(CANCEL_CHECK_INTERVAL)
+
+    for sess in sessions:
+        _release_sess(sess)
+
+
+def _drain_pipeline(sessions, ctl):
+
+    # Discard queued elements and wake up blocked threads with Finish.
+    # Returns True if there are still threads running.
+
+    running = False
+
+    if 'result_q' in ctl and len(sessions) > 0:
+        sessions[-1]['dropped'] += _drain(ctl['result_q'])
+
+    for sess in sessions:
+
+        sess['dropped'] += _drain(sess['input'])
+
+        nr_alive = len([th for th in sess['threads'][:] if th.is_alive()])
+        for ii in range(nr_alive):
+            try:
+                sess['input'].put(Finish, block=False)
+            except Queue.Full:
+                break
+
+        if nr_alive > 0:
+            running = True
+            continue
+
+        if 'coor_th' in sess and sess['coor_th'].is_alive():
+            running = True
+            if 'queue_of_outq' in sess:
+                try:
+                    sess['queue_of_outq'].put(Finish, block=False)
+                except Queue.Full:
+                    pass
+
+    return running
+
+
+def _drain(q):
+
+    nr = 0
+    while True:
+        try:
+            elt = q.get(block=False)
+        except Queue.Empty:
+            return nr
+
+        if elt is not Finish and elt is not _Shrink:
+            nr += 1
+
+
+def stat(probe):
+
+    rst = []
+    for sess in probe['sessions']:
+        o = {}
+        o['name'] = _sess_name(sess)
+        if 'fused_into' in sess:
+            o['fused_into'] = _sess_name(sess['fused_into'])
+        if 'stage' in sess:
+            o['stage'] = sess['stage']
+        o['executor'] = sess['executor']
+        o['threads'] = len(sess['threads'])
+        o['busy'] = _nr_busy(sess)
+        o.update(_thread_stats_sum(sess['stats'][:], sess['aux_stats'][:]))
+        o['dropped'] += sess['dropped']
+        if 'retry' in sess:
+            o['retry_waiting'] = sess['retry_sched'].qsize()
+
+        if 'cache' in sess:
+            o['cache'] = sess['cache'].stat()
+
+        o['input'] = _q_stat(sess['input'])
+        if 'reorder' in sess:
+            o['coordinator'] = _q_stat(sess['reorder'])
+        elif 'queue_of_outq' in sess:
+            o['coordinator'] = _q_stat(sess['queue_of_outq'])
+
+        if 'autoscale' in sess:
+            scale = sess['autoscale']
+            o['autoscale'] = {'min': scale['min'],
+                              'max': scale['max'],
+                              'grow': scale['grow'],
+                              'shrink': scale['shrink'],
+                              'last': scale['last'],
+                              }
+
+        rst.append(o)
+
+    return rst
+
+
+def _new_thread_stat(sess, aux=False):
+
+    # Every thread updates its own stat without lock.
+    # They are summed up when stat() is called.
+    # An aux stat is not of a thread calling the job and has no busy_time.
+    st = {'in': 0,
+          'out': 0,
+          'error': 0,
+          'dropped': 0,
+          'retry': 0,
+          'dead': 0,
+          'busy_time': 0.0,
+          # seconds spent waiting for rate limit
+          'throttle_time': 0.0,
+          'latency': [0] * (len(LATENCY_BOUNDS) + 1),
+          # [second, nr of items] for each of the recent seconds
+          'rate': [[0, 0] for ii in range(RATE_WINDOW + 1)],
+          # slot of 'rate' of the current second, until 'rate_end'
+          'rate_slot': None,
+          'rate_end': 0,
+          }
+
+    if aux:
+        sess['aux_stats'].append(st)
+    else:
+        sess['stats'].append(st)
+    return st
+
+
+def _record_call(st, t0, nr):
+
+    # It is called for every call of a job, keep it cheap.
+    # The only timestamp after the call is used for latency and rate.
+    t1 = time.time()
+    spent = t1 - t0
+
+    st['in'] += nr
+    st['busy_time'] += spent
+
+    # 2 ** (e - 1) <= spent < 2 ** e
+    idx = math.frexp(spent)[1] - LATENCY_MIN_EXP
+    if idx < 0 or spent <= 0:
+        idx = 0
+    elif idx > len(LATENCY_BOUNDS):
+        idx = len(LATENCY_BOUNDS)
+    st['latency'][idx] += 1
+
+    if t1 < st['rate_end']:
+        st['rate_slot'][1] += nr
+        return
+
+    sec = int(t1)
+    slot = st['rate'][sec % len(st['rate'])]
+    slot[0] = sec
+    slot[1] = nr
+    st['rate_slot'] = slot
+    st['rate_end'] = sec + 1
+
+
+def _thread_stats_sum(stats, aux_stats):
+
+    now = int(time.time())
+    nr_recent = 0
+    latency = [0] * (len(LATENCY_BOUNDS) + 1)
+
+    busy_time = [st['busy_time'] for st in stats]
+    stats = stats + aux_stats
+
+    for st in stats:
+
+        for ii, cnt in enumerate(st['latency']):
+            latency[ii] += cnt
+
+        # the current second is not complete yet
+        for sec, nr in st['rate'][:]:
+            if now - RATE_WINDOW <= sec < now:
+                nr_recent += nr
+
+    return {'in': sum([st['in'] for st in stats]),
+            'out': sum([st['out'] for st in stats]),
+            'error': sum([st['error'] for st in stats]),
+            'dropped': sum([st['dropped'] for st in stats]),
+            'retry': sum([st['retry'] for st in stats]),
+            'dead': sum([st['dead'] for st in stats]),
+            'busy_time': busy_time,
+            'throttle_time': sum([st['throttle_time'] for st in stats]),
+            'rate': nr_recent * 1.0 / RATE_WINDOW,
+            'latency': {'p50': _percentile(latency, 0.5),
+                        'p99': _percentile(latency, 0.99),
+                        },
+            }
+
+
+def _percentile(hist, q):
+
+    total = sum(hist)
+    if total == 0:
+        return None
+
+    acc = 0
+    for ii, cnt in enumerate(hist):
+        acc += cnt
+        if acc >= total * q:
+            break
+
+    return LATENCY_BOUNDS[min(ii, len(LATENCY_BOUNDS) - 1)]
+
+
+def _sess_name(sess):
+
+    wk = sess['worker']
+
+    # builtin functions or methods such as list.append have no module.
+    module = getattr(wk, '__module__', None)
+    if module is None:
+        return repr(wk)
+
+    return module + ":" + getattr(wk, '__name__', type(wk).__name__)
+
+
+def _q_stat(q):
+
+    if isinstance(getattr(q, 'queue', None), _SpillDeque):
+        # capa is the number of elements kept in memory
+        return {'size': q.qsize(),
+                'capa': q.queue.window * getattr(q, 'chunk', 1),
+                'spilled': q.queue.nr_spilled,
+                }
+
+    return {'size': q.qsize(),
+            'capa': q.maxsize * getattr(q, 'chunk', 1)
+            }
+
 
+def _exec(sess, output_q):
 
-class Finish(object):
-    pass
+    me = threading.current_thread()
+    busy = sess['busy']
+    st = _new_thread_stat(sess)
 
+    if 'partition_key' in sess:
+        sess['input'].bind()
 
-def run(input_it, workers, keep_order=False, timeout=None, probe=None):
+    while True:
 
-    endtime = time.time() + (timeout or 86400 * 365)
-    if probe is None:
-        probe = {}
-    sessions = []
-    probe['sessions'] = sessions
-    head_q = _make_q()
-    inq = head_q
+        args = _get_args(sess)
+        if args is Finish or args is _Shrink:
+            _task_done(sess, 1)
 
-    for worker in workers + [_blackhole]:
+        if args is Finish:
+            return
+        if args is _Shrink:
+            _remove_thread(sess, me)
+            return
 
-        if callable(worker):
-            worker = (worker, 1)
+        nr = _nr_args(sess, args)
 
-        worker, n = worker
+        if _is_stopped(sess['ctl']):
+            st['dropped'] += nr
+            return
 
-        sess = {'worker': worker,
-                'threads': [],
-                'input': inq,
-                }
+        args, tries = _unwrap_retry(sess, args)
+        _throttle(sess, st, nr)
 
-        outq = _make_q()
+        busy[me] = True
+        t0 = time.time()
+        try:
+            rst = sess['call'](args)
+        except Exception as e:
+            logger.exception(repr(e))
+            st['error'] += 1
+            _retry_or_give_up(sess, st, args, tries, None, e)
+            continue
+        finally:
+            busy[me] = False
+            _record_call(st, t0, nr)
 
-        if keep_order and n > 1:
-            # to maximize concurrency
-            sess['queue_of_outq'] = _make_q(n=1024 * 1024)
-            sess['lock'] = threading.RLock()
-            sess['coor_th'] = _thread(_coordinate, (sess, outq))
+        st['out'] += _put_rst(output_q, rst)
+        _task_done(sess, nr)
 
-            sess['threads'] = [_thread(_exec_in_order, (sess, _make_q()))
-                               for ii in range(n)]
-        else:
-            sess['threads'] = [_thread(_exec, (sess, outq))
-                               for ii in range(n)]
 
-        sessions.append(sess)
-        inq = outq
+def _exec_in_order(sess):
 
-    for args in input_it:
-        head_q.put(args)
+    me = threading.current_thread()
+    busy = sess['busy']
+    reorder = sess['reorder']
+    st = _new_thread_stat(sess)
 
-    for sess in sessions:
+    while True:
 
-        # put nr = len(threads) Finish
-        for th in sess['threads']:
-            sess['input'].put(Finish)
+        args = _get_args(sess)
+        seqs = sess['input'].pop_seqs()
 
-        for th in sess['threads']:
-            th.join(endtime - time.time())
+        if args is Finish or args is _Shrink:
+            for seq in seqs:
+                reorder.put(seq, EmptyRst, block=False)
+            _task_done(sess, 1)
 
-        if 'queue_of_outq' in sess:
-            sess['queue_of_outq'].put(Finish)
-            sess['coor_th'].join(endtime - time.time())
+            if args is _Shrink:
+                _remove_thread(sess, me)
+            return
 
+        nr = _nr_args(sess, args)
 
-def stat(probe):
+        if _is_stopped(sess['ctl']):
+            st['dropped'] += nr
+            return
 
-    rst = []
-    for sess in probe['sessions']:
-        o = {}
-        wk = sess['worker']
-        o['name'] = wk.__module__ + ":" + wk.__name__
+        args, tries = _unwrap_retry(sess, args)
+        if tries is not None:
+            # retried elements are taken, other threads can wait for room.
+            reorder.hold(-len([x for x in tries if x > 0]))
 
-        o['input'] = _q_stat(sess['input'])
-        if 'queue_of_outq' in sess:
-            o['coordinator'] = _q_stat(sess['queue_of_outq'])
+        _throttle(sess, st, nr)
 
-        rst.append(o)
+        busy[me] = True
+        t0 = time.time()
+        failed = False
+        try:
+            rst = sess['call'](args)
+            if 'batch' in sess:
+                rsts = list(rst)
+            else:
+                rsts = [rst]
 
-    return rst
+        except Exception as e:
+            logger.exception(repr(e))
+            st['error'] += 1
+            failed = True
+            rsts = []
+            retried = _retry_or_give_up(sess, st, args, tries, seqs, e)
+            seqs = [x for x in seqs if x not in retried]
 
+        finally:
+            busy[me] = False
+            _record_call(st, t0, nr)
 
-def _q_stat(q):
-    return {'size': q.qsize(),
-            'capa': q.maxsize
-            }
+        # a batch may be followed by a Finish that is put back to input.
+        for jj, seq in enumerate(seqs):
+            if jj < len(rsts):
+                reorder.put(seq, rsts[jj])
+            else:
+                reorder.put(seq, EmptyRst, block=False)
 
+        if not failed:
+            _task_done(sess, nr)
 
-def _exec(sess, output_q):
+
+def _exec_fused(sess, output_q):
+
+    # Call functions of fused stages back to back. Every stage records its
+    # own stat.
+
+    me = threading.current_thread()
+    busy = sess['busy']
+    chain = [(sess, _new_thread_stat(sess))]
+    chain += [(x, _new_thread_stat(x)) for x in sess['fused']]
 
     while True:
 
         args = sess['input'].get()
         if args is Finish:
+            _task_done(sess, 1)
+            return
+
+        if _is_stopped(sess['ctl']):
+            chain[0][1]['dropped'] += 1
             return
 
+        busy[me] = True
         try:
-            rst = sess['worker'](args)
-        except Exception as e:
-            logger.exception(repr(e))
+            _call_fused(chain, 0, args, output_q)
+        finally:
+            busy[me] = False
+
+        _task_done(sess, 1)
+
+
+def _call_fused(chain, ii, args, output_q):
+
+    # call the ii-th stage and deliver its results to the next one, or to
+    # output_q from the last one.
+
+    fsess, st = chain[ii]
+
+    t0 = time.time()
+    try:
+        rst = fsess['call'](args)
+    except Exception as e:
+        logger.exception(repr(e))
+        st['error'] += 1
+        return
+    finally:
+        _record_call(st, t0, 1)
+
+    if ii == len(chain) - 1:
+        st['out'] += _put_rst(output_q, rst)
+        return
+
+    if type(rst) != types.GeneratorType:
+        rst = [rst]
+
+    for rr in rst:
+        if rr is not EmptyRst:
+            st['out'] += 1
+            _call_fused(chain, ii + 1, rr, output_q)
+
+
+def _add_thread(sess):
+
+    if sess['ordered']:
+        args = (sess, )
+        target = _exec_in_order
+    elif 'fused' in sess:
+        args = (sess, sess['output'])
+        target = _exec_fused
+    else:
+        args = (sess, sess['output'])
+        target = _exec
+
+    th = threading.Thread(target=target, args=args)
+    th.daemon = True
+
+    with sess['threads_lock']:
+        sess['threads'].append(th)
+        sess['busy'][th] = False
+        _set_consumers(sess)
+
+    th.start()
+
+
+def _remove_thread(sess, th):
+
+    with sess['threads_lock']:
+        sess['threads'].remove(th)
+        del sess['busy'][th]
+        _set_consumers(sess)
+
+
+def _set_consumers(sess):
+    # a chunk is shared among threads of the stage.
+    if isinstance(sess['input'], _ChunkQueue):
+        sess['input'].consumers = max(len(sess['threads']), 1)
+
+
+def _nr_busy(sess):
+    with sess['threads_lock']:
+        return len([x for x in sess['busy'].values() if x])
+
+
+def _start_autoscale(sess, n_range):
+
+    sess['autoscale'] = {'min': n_range[0],
+                         'max': n_range[1],
+                         'grow': 0,
+                         'shrink': 0,
+                         'last': None,
+                         'stop': threading.Event(),
+                         }
+    sess['autoscale']['thread'] = _thread(_autoscale, (sess, ))
+
+
+def _stop_autoscale(sess, ctl):
+
+    # keep scaling until the backlog is consumed. There is no more input
+    # since upstream threads have quit.
+    while sess['input'].qsize() > 0 and not _is_stopped(ctl):
+        time.sleep(AUTOSCALE_INTERVAL)
+
+    sess['autoscale']['stop'].set()
+    sess['autoscale']['thread'].join()
+
+
+def _autoscale(sess):
+
+    scale = sess['autoscale']
+
+    while not scale['stop'].wait(AUTOSCALE_INTERVAL):
+
+        qsize = sess['input'].qsize()
+        nr_threads = len(sess['threads'])
+        nr_busy = _nr_busy(sess)
+        busy_ratio = nr_busy * 1.0 / max(nr_threads, 1)
+
+        if qsize > 0 and busy_ratio >= 0.8 and nr_threads < scale['max']:
+
+            # grow fast: at most double the threads every time.
+            delta = min(scale['max'] - nr_threads, qsize,
+                        max(nr_threads, 1))
+            for ii in range(delta):
+                _add_thread(sess)
+
+            scale['grow'] += delta
+            action = 'grow'
+
+        elif qsize == 0 and busy_ratio < 0.5 and nr_threads > scale['min']:
+
+            # shrink slowly: one thread at a time.
+            try:
+                sess['input'].put(_Shrink, block=False)
+            except Queue.Full:
+                continue
+
+            scale['shrink'] += 1
+            delta = -1
+            action = 'shrink'
+
+        else:
             continue
 
-        _put_rst(output_q, rst)
+        scale['last'] = {'time': time.time(),
+                         'action': action,
+                         'threads': nr_threads + delta,
+                         'input_size': qsize,
+                         'busy_ratio': busy_ratio,
+                         }
 
 
-def _exec_in_order(sess, output_q):
+def _exec_async(sess, keep_order):
+
+    # time spent in coroutines is recorded by _collect_async.
+    st = _new_thread_stat(sess, aux=True)
 
     while True:
 
-        with sess['lock']:
+        args = _get_args(sess)
+        if args is Finish:
+            _task_done(sess, 1)
+            break
+
+        if _is_stopped(sess['ctl']):
+            st['dropped'] += _nr_args(sess, args)
+            break
 
-            args = sess['input'].get()
-            if args is Finish:
-                return
-            sess['queue_of_outq'].put(output_q)
+        args, tries = _unwrap_retry(sess, args)
+        _throttle(sess, st, _nr_args(sess, args))
+
+        # limit the number of in-flight coroutines
+        sess['sema'].acquire()
+
+        t0 = time.time()
+        fut = asyncio.run_coroutine_threadsafe(sess['call'](args),
+                                               sess['loop'])
+        if keep_order:
+            sess['queue_of_outq'].put((t0, args, tries, fut))
+        else:
+            fut.add_done_callback(
+                lambda f, elt=(t0, args, tries):
+                sess['queue_of_outq'].put(elt + (f, )))
+
+    # wait for all in-flight coroutines to be collected, before coordinator
+    # receives Finish.
+    for ii in range(sess['concurrency']):
+        sess['sema'].acquire()
+
+
+def _collect_async(sess, output_q):
+
+    # the stat of the feeder thread, the only thread of an async stage.
+    st = _new_thread_stat(sess)
+
+    while True:
 
         try:
-            rst = sess['worker'](args)
+            elt = sess['queue_of_outq'].get(block=False)
+        except Queue.Empty:
+            _flush_chunks()
+            elt = sess['queue_of_outq'].get()
+
+        if elt is Finish:
+            _flush_chunks()
+            return
 
+        t0, args, tries, fut = elt
+        nr = _nr_args(sess, args)
+        try:
+            rst = fut.result()
+            if 'batch' in sess:
+                rst = _batch_rsts(args, rst)
         except Exception as e:
             logger.exception(repr(e))
-            output_q.put(EmptyRst)
+            st['error'] += 1
+            _retry_or_give_up(sess, st, args, tries, None, e)
+            continue
+        finally:
+            sess['sema'].release()
+            # latency of a coroutine is measured from submission to
+            # collection.
+            _record_call(st, t0, nr)
+
+        if _is_stopped(sess['ctl']):
+            # keep collecting to let feeder quit
+            st['dropped'] += nr
             continue
 
-        output_q.put(rst)
+        if 'batch' in sess:
+            rst = (rr for rr in rst)
+
+        st['out'] += _put_rst(output_q, rst)
+        _task_done(sess, nr)
+
+
+def _run_loop(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def _close_loop(sess):
+
+    loop = sess['loop']
+    loop.call_soon_threadsafe(loop.stop)
+    sess['loop_th'].join(1)
+
+    if not sess['loop_th'].is_alive():
+        loop.close()
 
 
 def _coordinate(sess, output_q):
 
+    st = _new_thread_stat(sess, aux=True)
+
     while True:
 
-        outq = sess['queue_of_outq'].get()
-        if outq is Finish:
+        rsts = sess['reorder'].get(block=False)
+        if rsts == []:
+            _flush_chunks()
+            rsts = sess['reorder'].get()
+
+        if rsts is Finish:
+            _flush_chunks()
+            return
+
+        if _is_stopped(sess['ctl']):
+            st['dropped'] += len(rsts)
+            return
+
+        for rst in rsts:
+            st['out'] += _put_rst(output_q, rst)
+
+        sess['reorder'].task_done(len(rsts))
+
+
+def _parse_worker(worker):
+
+    if callable(worker):
+        worker = (worker, 1)
+
+    if len(worker) == 2:
+        worker, n = worker
+        opts = {}
+    else:
+        worker, n, opts = worker
+
+    # (func, (min, max)) scales the number of threads between min and max.
+    if isinstance(n, tuple):
+        autoscale = n
+        n, max_n = n
+        if not 0 < n <= max_n:
+            raise ValueError('invalid thread range: ' + repr(autoscale))
+    else:
+        autoscale = None
+        max_n = n
+
+    # (func, n, 'process') is short for (func, n, {'executor': 'process'})
+    if isinstance(opts, str):
+        opts = {'executor': opts}
+
+    for k in opts:
+        if k not in ('executor', 'batch', 'retry', 'dead_letter', 'rate',
+                     'partition_key', 'spill', 'cache'):
+            raise ValueError('invalid worker option: ' + repr(k))
+
+    executor = opts.get('executor')
+    if executor is None:
+        if _is_coroutine_function(worker):
+            executor = 'async'
+        else:
+            executor = 'thread'
+
+    if executor not in ('thread', 'process', 'async'):
+        raise ValueError('invalid executor: ' + repr(executor))
+
+    if executor == 'async' and asyncio is None:
+        raise ValueError('async executor requires asyncio')
+
+    if executor == 'async' and autoscale is not None:
+        raise ValueError('async executor does not support thread range')
+
+    batch = opts.get('batch')
+    if batch is not None:
+        max_items, max_wait = batch
+        if max_items < 1:
+            raise ValueError('invalid batch size: ' + repr(max_items))
+
+    retry = opts.get('retry')
+    if retry is None and opts.get('dead_letter') is not None:
+        retry = (0, 0)
+
+    if retry is not None:
+        retries, backoff = retry
+        if retries < 0 or backoff < 0:
+            raise ValueError('invalid retry: ' + repr(retry))
+
+    # 'rate': items per second, or (items per second, burst)
+    rate = opts.get('rate')
+    if rate is not None:
+        if not isinstance(rate, tuple):
+            rate = (rate, 1)
+        qps, burst = rate
+        if qps <= 0 or burst < 1:
+            raise ValueError('invalid rate: ' + repr(rate))
+
+    partition_key = opts.get('partition_key')
+    if partition_key is not None:
+        if not callable(partition_key):
+            raise ValueError('invalid partition_key: ' + repr(partition_key))
+        if executor == 'async':
+            raise ValueError('async executor does not support partition_key')
+        if autoscale is not None:
+            raise ValueError('partition_key does not support thread range')
+
+    # 'spill': directory, or (directory, number of elements in memory)
+    spill = opts.get('spill')
+    if spill is not None:
+        if not isinstance(spill, tuple):
+            spill = (spill, 1024)
+        path, window = spill
+        if not os.path.isdir(path) or window < 1:
+            raise ValueError('invalid spill: ' + repr(spill))
+        if partition_key is not None:
+            raise ValueError('partition_key does not support spill')
+
+    # 'cache': size, or (size, ttl), or (size, ttl, key_func)
+    cache = opts.get('cache')
+    if cache is not None:
+        if not isinstance(cache, tuple):
+            cache = (cache, )
+        cache = (cache + (None, None))[:3]
+        size, ttl, key_func = cache
+        if size < 1 or (ttl is not None and ttl <= 0):
+            raise ValueError('invalid cache: ' + repr(cache))
+        if executor == 'async' or batch is not None:
+            raise ValueError('cache does not support async executor or'
+                             ' batch')
+
+    return {'worker': worker,
+            'cache': cache,
+            'partition_key': partition_key,
+            'spill': spill,
+            'rate': rate,
+            'retry': retry,
+            'dead_letter': opts.get('dead_letter'),
+            'n': n,
+            'max_n': max_n,
+            'autoscale': autoscale,
+            'executor': executor,
+            'batch': batch,
+            }
+
+
+def _is_coroutine_function(worker):
+    return (asyncio is not None
+            and inspect.iscoroutinefunction(worker))
+
+
+def _process_caller(pool, worker):
+
+    def _call(args):
+        is_gen, rst = pool.apply(_call_in_process, (worker, args))
+        if is_gen:
+            return (rr for rr in rst)
+        return rst
+
+    return _call
+
+
+def _call_in_process(worker, args):
+
+    # a generator can not be sent back to parent process, evaluate it here.
+    rst = worker(args)
+    if type(rst) == types.GeneratorType:
+        return True, list(rst)
+
+    return False, rst
+
+
+def _close_pool(sess):
+
+    pool = sess['pool']
+
+    if any([th.is_alive() for th in sess['threads']]):
+        # timed out, some of the tasks are still running.
+        pool.terminate()
+    else:
+        pool.close()
+        pool.join()
+
+
+def _get_args(sess):
+
+    if 'batch' in sess:
+        return _get_batch(sess)
+
+    return sess['input'].get()
+
+
+def _get_batch(sess):
+
+    max_items, max_wait = sess['batch']
+    inq = sess['input']
+
+    args = inq.get()
+    if args is Finish or args is _Shrink:
+        return args
+
+    batch = [args]
+    deadline = time.time() + max_wait
+
+    while len(batch) < max_items:
+
+        timeout = deadline - time.time()
+        if timeout <= 0:
+            break
+
+        try:
+            args = inq.get(timeout=timeout)
+        except Queue.Empty:
+            break
+
+        if args is Finish or args is _Shrink:
+            # deliver the partial batch first, exit on the next get.
+            inq.put(args)
+            _task_done(sess, 1)
+            break
+
+        batch.append(args)
+
+    return batch
+
+
+def _throttle(sess, st, nr):
+
+    # wait for the rate limit of the stage before calling the worker.
+    # The thread is not busy while it waits.
+
+    if 'rate' not in sess:
+        return
+
+    wait = sess['rate'].take(nr)
+    if wait <= 0:
+        return
+
+    st['throttle_time'] += wait
+
+    until = time.time() + wait
+    while not _is_stopped(sess['ctl']):
+        wait = until - time.time()
+        if wait <= 0:
             return
+        time.sleep(min(wait, CANCEL_CHECK_INTERVAL))
+
+
+def _task_done(sess, nr):
+
+    # Only a stage with retry or of a Pipeline tracks unfinished elements,
+    # to know when no more retry will be queued or the pipeline is idle.
+
+    if 'retry' not in sess and 'track_tasks' not in sess['ctl']:
+        return
+
+    for ii in range(nr):
+        sess['input'].task_done()
+
+
+def _unwrap_retry(sess, args):
+
+    # Returns args without _Retry wrapper and the number of tries of each
+    # element. Tries is None if retry is disabled.
+
+    if 'retry' not in sess:
+        return args, None
+
+    if 'batch' in sess:
+        elts = args
+    else:
+        elts = [args]
+
+    tries = [x.tries if isinstance(x, _Retry) else 0 for x in elts]
+    elts = [x.args if isinstance(x, _Retry) else x for x in elts]
+
+    if 'batch' in sess:
+        return elts, tries
+    else:
+        return elts[0], tries
+
+
+def _retry_or_give_up(sess, st, args, tries, seqs, err):
+
+    # Schedule failed elements to retry, or send them to dead letter if
+    # retries are used up.
+    # Returns sequence numbers of elements retried.
+
+    if 'retry' not in sess:
+        # the failed elements are done.
+        _task_done(sess, _nr_args(sess, args))
+        return []
+
+    if 'batch' in sess:
+        elts = args
+    else:
+        elts = [args]
+
+    retries, backoff = sess['retry']
+    retried = []
+
+    for ii, elt in enumerate(elts):
+
+        seq = seqs[ii] if seqs is not None else None
+
+        if tries[ii] < retries:
+            if seq is not None:
+                sess['reorder'].hold(1)
+                retried.append(seq)
+
+            st['retry'] += 1
+            sess['retry_sched'].add(_Retry(elt, tries[ii] + 1, seq),
+                                    backoff * 2 ** tries[ii])
+            continue
+
+        st['dead'] += 1
+        if sess['dead_letter'] is not None:
+            try:
+                sess['dead_letter']((elt, err))
+            except Exception as e:
+                logger.exception(repr(e))
+
+        _task_done(sess, 1)
+
+    return retried
+
+
+def _set_key_error(sess, q):
 
-        _put_rst(output_q, outq.get())
+    # errors of key_func of q are counted in sess.
+    if 'key_stat' not in sess:
+        sess['key_stat'] = _new_thread_stat(sess, aux=True)
+
+    q.on_key_error = lambda elt, err: _key_error(sess, elt, err)
+
+
+def _key_error(sess, elt, err):
+
+    # key_func raised for an element in the thread putting it. The element
+    # is given up as if the job failed on it.
+
+    logger.error('key_func error: ' + repr(err))
+
+    if isinstance(elt, _Retry):
+        # it is unfinished since it failed the first time.
+        elt = elt.args
+        _task_done(sess, 1)
+
+    with sess['threads_lock']:
+        st = sess['key_stat']
+        st['error'] += 1
+        if 'retry' in sess:
+            st['dead'] += 1
+
+    if sess.get('dead_letter') is not None:
+        try:
+            sess['dead_letter']((elt, err))
+        except Exception as e:
+            logger.exception(repr(e))
+
+
+def _batch_caller(call):
+
+    def _call(batch):
+        # worker returns one result for every item, they are delivered to
+        # next job one by one.
+        rsts = _batch_rsts(batch, call(batch))
+        return (rr for rr in rsts)
+
+    return _call
+
+
+def _batch_rsts(batch, rst):
+
+    # a wrong number of results is an error of the worker, then no result
+    # is mismatched with an element.
+
+    rsts = list(rst)
+    if len(rsts) != len(batch):
+        raise ValueError('batch worker returned {0} results for {1}'
+                         ' elements'.format(len(rsts), len(batch)))
+
+    return rsts
+
+
+def _cache_caller(cache, call, key_func):
+
+    def _call(args):
+
+        if key_func is None:
+            key = args
+        else:
+            key = key_func(args)
+
+        try:
+            hash(key)
+        except TypeError:
+            return call(args)
+
+        return cache.call(call, key, args)
+
+    return _call
+
+
+def _nr_args(sess, args):
+    if 'batch' in sess:
+        return len(args)
+    return 1
 
 
 def _put_rst(output_q, rst):
 
+    # returns the number of elements put
+
     if type(rst) == types.GeneratorType:
+        nr = 0
         for rr in rst:
-            _put_non_empty(output_q, rr)
+            nr += _put_non_empty(output_q, rr)
+        return nr
     else:
-        _put_non_empty(output_q, rst)
+        return _put_non_empty(output_q, rst)
 
 
 def _blackhole(args):
@@ -165,9 +2733,16 @@ def _blackhole(args):
 def _put_non_empty(q, val):
     if val is not EmptyRst:
         q.put(val)
+        return 1
+    return 0
 
 
-def _make_q(n=1024):
+def _make_q(n=1024, ordered=False, chunk=None):
+    if ordered:
+        return _SeqQueue(n)
+    if chunk is not None:
+        # about the same number of elements as an unchunked queue.
+        return _ChunkQueue(max(n // chunk, 2), chunk)
     return Queue.Queue(n)
 
 
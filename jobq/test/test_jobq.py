@@ -1,6 +1,18 @@
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
 import time
 import unittest
 
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
 import jobq
 
 
@@ -24,6 +36,18 @@ def discard_even(args):
         return args
 
 
+def err_on_even(args):
+    if args % 2 == 0:
+        raise Exception('even number')
+    else:
+        return args
+
+
+def gen_3(args):
+    for i in range(3):
+        yield i
+
+
 def sleep_5(args):
     time.sleep(5)
     return args
@@ -39,10 +63,103 @@ class TestProbe(unittest.TestCase):
         self.assertEqual(True, stat[0]['name'].endswith('multi2'))
         self.assertEqual(0, stat[0]['input']['size'])
         self.assertEqual(True, stat[0]['input']['capa'] > 0)
+        self.assertEqual(1, stat[0]['threads'])
+        self.assertEqual(0, stat[0]['busy'])
+        self.assertEqual(False, 'autoscale' in stat[0])
+
+
+class TestStat(unittest.TestCase):
+
+    def test_counters(self):
+
+        probe = {}
+        jobq.run(range(100), [add1, (err_on_even, 3), discard_even,
+                              (multi2_batch, 2, {'batch': (10, 0.1)})],
+                 probe=probe)
+        stat = jobq.stat(probe)
+
+        self.assertEqual([100, 100, 50, 50, 50],
+                         [x['in'] for x in stat])
+        self.assertEqual([100, 50, 50, 50, 0],
+                         [x['out'] for x in stat])
+        self.assertEqual([0, 50, 0, 0, 0],
+                         [x['error'] for x in stat])
+
+    def test_counters_keep_order(self):
+
+        probe = {}
+        jobq.run(range(100), [(err_on_even, 3), (gen_3, 2)],
+                 keep_order=True, probe=probe)
+        stat = jobq.stat(probe)
+
+        self.assertEqual([100, 50, 150], [x['in'] for x in stat])
+        self.assertEqual([50, 150, 0], [x['out'] for x in stat])
+        self.assertEqual([50, 0, 0], [x['error'] for x in stat])
+
+    def test_busy_time_and_latency(self):
+
+        probe = {}
+        jobq.run(range(20), [(multi2_sleep, 2)], probe=probe)
+        stat = jobq.stat(probe)[0]
+
+        self.assertEqual(2, len(stat['busy_time']))
+        self.assertTrue(0.4 <= sum(stat['busy_time']) < 0.8)
+        # buckets are powers of 2: 0.02 is in (1/64, 1/32]
+        self.assertEqual(1.0 / 32, stat['latency']['p50'])
+        self.assertTrue(1.0 / 32 <= stat['latency']['p99'] <= 1.0 / 16)
+
+    def test_busy_time_of_worker_threads(self):
+
+        # coordinator is not a thread calling the job.
+        probe = {}
+        jobq.run(range(20), [(multi2, 3), (add1, 1)], keep_order=True,
+                 probe=probe)
+        stat = jobq.stat(probe)
+
+        self.assertEqual([3, 1], [len(x['busy_time']) for x in stat[:2]])
+        self.assertEqual([20, 20], [x['out'] for x in stat[:2]])
+
+    def test_rate(self):
+
+        probe = {}
+
+        def slow_input():
+            # make sure the window covers at least one complete second
+            for ii in range(10):
+                yield ii
+            time.sleep(1.1)
+
+        jobq.run(slow_input(), [multi2], probe=probe)
+        stat = jobq.stat(probe)
+        self.assertEqual(10 * 1.0 / jobq.RATE_WINDOW, stat[0]['rate'])
+
+    def test_empty(self):
+
+        probe = {}
+        jobq.run([], [multi2], probe=probe)
+        stat = jobq.stat(probe)[0]
+
+        self.assertEqual(0, stat['in'])
+        # one for each thread, even if it did nothing.
+        self.assertEqual([0.0], stat['busy_time'])
+        self.assertEqual(0, stat['rate'])
+        self.assertEqual({'p50': None, 'p99': None}, stat['latency'])
 
 
 class TestJobQ(unittest.TestCase):
 
+    def test_builtin_worker(self):
+
+        out = []
+        rst = jobq.run(range(3), [out.append])
+
+        self.assertEqual([0, 1, 2], out)
+        self.assertEqual(3, rst['completed'])
+
+        probe = {}
+        jobq.run(range(3), [out.append], probe=probe)
+        self.assertEqual(repr(out.append), jobq.stat(probe)[0]['name'])
+
     def test_timeout(self):
 
         def collect(args):
@@ -136,6 +253,1692 @@ class TestJobQ(unittest.TestCase):
         self.assertEqual(9, len(rst), 'nr of elts')
 
 
+class TestKeepOrder(unittest.TestCase):
+
+    def test_slow_element_does_not_block_others(self):
+
+        def slow_first(args):
+            if args == 0:
+                time.sleep(0.5)
+                done_before_first.append(len(done))
+            done.append(args)
+            return args
+
+        def collect(args):
+            rst.append(args)
+
+        rst = []
+        done = []
+        done_before_first = []
+        jobq.run(range(100), [(slow_first, 4), collect], keep_order=True)
+        self.assertEqual(list(range(100)), rst)
+        self.assertEqual([99], done_before_first)
+
+    def test_small_window(self):
+
+        def collect(args):
+            rst.append(args)
+
+        orig = jobq.REORDER_WINDOW
+        jobq.REORDER_WINDOW = 2
+        try:
+            rst = []
+            jobq.run(range(200), [(multi2_sleep, 8), (gen_3, 3), collect],
+                     keep_order=True)
+            self.assertEqual([0, 1, 2] * 200, rst)
+        finally:
+            jobq.REORDER_WINDOW = orig
+
+    def test_ordered_stat(self):
+
+        probe = {}
+        jobq.run(range(10), [(multi2, 3)], keep_order=True, probe=probe)
+        stat = jobq.stat(probe)
+        self.assertEqual(0, stat[0]['coordinator']['size'])
+        self.assertEqual(jobq.REORDER_WINDOW,
+                         stat[0]['coordinator']['capa'])
+
+
+class TestProcessExecutor(unittest.TestCase):
+
+    def test_process(self):
+
+        def collect(args):
+            rst.append(args)
+
+        rst = []
+        jobq.run(range(100), [add1, (multi2, 4, 'process'), collect])
+        self.assertEqual(set(range(2, 202, 2)), set(rst))
+
+        rst = []
+        jobq.run(range(100), [add1, (multi2_sleep, 4, 'process'), collect],
+                 keep_order=True)
+        self.assertEqual(list(range(2, 202, 2)), rst)
+
+    def test_process_generator_and_empty(self):
+
+        def collect(args):
+            rst.append(args)
+
+        rst = []
+        jobq.run(range(3), [(gen_3, 2, 'process'), collect], keep_order=True)
+        self.assertEqual([0, 1, 2] * 3, rst)
+
+        rst = []
+        jobq.run(range(10), [(discard_even, 2, 'process'), collect])
+        self.assertEqual(set(range(1, 10, 2)), set(rst))
+
+    def test_process_exception(self):
+
+        def collect(args):
+            rst.append(args)
+
+        rst = []
+        jobq.run(range(10), [(err_on_even, 2, 'process'), collect],
+                 keep_order=True)
+        self.assertEqual(list(range(1, 10, 2)), rst)
+
+    def test_process_stat(self):
+
+        probe = {}
+        jobq.run(range(10), [(multi2, 2, 'process')], probe=probe)
+        stat = jobq.stat(probe)
+        self.assertEqual('process', stat[0]['executor'])
+        self.assertEqual('thread', stat[1]['executor'])
+        self.assertEqual(0, stat[0]['input']['size'])
+
+    def test_invalid_executor(self):
+        self.assertRaises(ValueError, jobq.run, range(3), [(multi2, 1, 'foo')])
+
+
+if sys.version_info[0] >= 3:
+    # "async def" is a syntax error in python2
+    exec('''
+async def multi2_async(args):
+    await asyncio.sleep(0.1)
+    return args * 2
+
+async def sleep_reverse_async(args):
+    await asyncio.sleep(0.02 * (10 - args))
+    return args
+
+async def multi2_batch_async(batch):
+    await asyncio.sleep(0.01)
+    return [x * 2 for x in batch]
+
+async def err_on_even_async(args):
+    if args % 2 == 0:
+        raise Exception('even number')
+    return args
+''')
+
+
+@unittest.skipIf(asyncio is None, 'asyncio is not available')
+class TestAsyncExecutor(unittest.TestCase):
+
+    def test_async(self):
+
+        def collect(args):
+            rst.append(args)
+
+        rst = []
+        t0 = time.time()
+        jobq.run(range(100), [add1, (multi2_async, 100), collect])
+        self.assertEqual(set(range(2, 202, 2)), set(rst))
+        self.assertLess(time.time() - t0, 1, 'coroutines run concurrently')
+
+    def test_async_keep_order(self):
+
+        def collect(args):
+            rst.append(args)
+
+        rst = []
+        jobq.run(range(10), [(sleep_reverse_async, 10), collect])
+        self.assertNotEqual(list(range(10)), rst)
+        self.assertEqual(set(range(10)), set(rst))
+
+        rst = []
+        jobq.run(range(10), [(sleep_reverse_async, 10), collect],
+                 keep_order=True)
+        self.assertEqual(list(range(10)), rst)
+
+    def test_async_concurrency_limit(self):
+
+        def collect(args):
+            rst.append(args)
+
+        rst = []
+        t0 = time.time()
+        jobq.run(range(10), [(multi2_async, 2, 'async'), collect])
+        self.assertEqual(set(range(0, 20, 2)), set(rst))
+        self.assertGreater(time.time() - t0, 0.5)
+
+    def test_async_mixed_with_threads(self):
+
+        def collect(args):
+            rst.append(args)
+
+        rst = []
+        jobq.run(range(100), [(add1, 3), (multi2_async, 10),
+                              (multi2_sleep, 4), (multi2_async, 50), collect],
+                 keep_order=True)
+        self.assertEqual(list(range(8, 808, 8)), rst)
+
+    def test_async_exception(self):
+
+        def collect(args):
+            rst.append(args)
+
+        rst = []
+        jobq.run(range(10), [(err_on_even_async, 3), collect],
+                 keep_order=True)
+        self.assertEqual(list(range(1, 10, 2)), rst)
+
+    def test_async_batch(self):
+
+        def collect(args):
+            rst.append(args)
+
+        rst = []
+        jobq.run(range(100), [(multi2_batch_async, 3, {'batch': (7, 0.1)}),
+                              collect],
+                 keep_order=True)
+        self.assertEqual(list(range(0, 200, 2)), rst)
+
+    def test_async_stat(self):
+
+        probe = {}
+        jobq.run(range(10), [(multi2_async, 2)], probe=probe)
+        stat = jobq.stat(probe)
+        self.assertEqual('async', stat[0]['executor'])
+        self.assertEqual(0, stat[0]['input']['size'])
+        self.assertEqual(0, stat[0]['coordinator']['size'])
+
+
+def multi2_batch(batch):
+    return [x * 2 for x in batch]
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_batch(self):
+
+        def collect(args):
+            rst.append(args)
+
+        def multi2_batch_sizes(batch):
+            sizes.append(len(batch))
+            return [x * 2 for x in batch]
+
+        for n, keep_order in ((1, False), (4, False), (4, True)):
+
+            rst = []
+            sizes = []
+            jobq.run(range(1000),
+                     [add1,
+                      (multi2_batch_sizes, n, {'batch': (10, 0.1)}),
+                      collect],
+                     keep_order=keep_order)
+
+            self.assertEqual(1000, sum(sizes))
+            self.assertTrue(max(sizes) <= 10)
+            self.assertTrue(len(sizes) < 1000, 'items are batched')
+
+            if keep_order:
+                self.assertEqual(list(range(2, 2002, 2)), rst)
+            else:
+                self.assertEqual(set(range(2, 2002, 2)), set(rst))
+
+    def test_batch_max_wait(self):
+
+        def slow_input():
+            for i in range(3):
+                yield i
+                time.sleep(0.2)
+
+        def collect_batch(batch):
+            batches.append(batch)
+            return batch
+
+        batches = []
+        jobq.run(slow_input(), [(collect_batch, 1, {'batch': (10, 0.05)})])
+        self.assertEqual([[0], [1], [2]], batches)
+
+    def test_batch_empty_rst(self):
+
+        def discard_even_batch(batch):
+            return [discard_even(x) for x in batch]
+
+        def collect(args):
+            rst.append(args)
+
+        rst = []
+        jobq.run(range(10),
+                 [(discard_even_batch, 2, {'batch': (3, 0.1)}), collect],
+                 keep_order=True)
+        self.assertEqual([1, 3, 5, 7, 9], rst)
+
+    def test_batch_wrong_nr_rst(self):
+
+        def collect(args):
+            rst.append(args)
+
+        def drop_last(batch):
+            return batch[:-1]
+
+        for keep_order in (False, True):
+            for opts in ({'batch': (3, 0.1)},
+                         {'batch': (3, 0.1), 'retry': (1, 0.01)}):
+
+                rst = []
+                probe = {}
+                jobq.run(range(9), [(drop_last, 2, opts), collect],
+                         keep_order=keep_order, probe=probe)
+
+                self.assertEqual([], rst)
+
+                stat = jobq.stat(probe)
+                self.assertTrue(stat[0]['error'] > 0)
+                self.assertEqual(0, stat[1]['in'])
+
+    def test_batch_process(self):
+
+        def collect(args):
+            rst.append(args)
+
+        rst = []
+        jobq.run(range(100),
+                 [(multi2_batch, 2, {'executor': 'process',
+                                     'batch': (8, 0.1)}),
+                  collect],
+                 keep_order=True)
+        self.assertEqual(list(range(0, 200, 2)), rst)
+
+    def test_invalid_option(self):
+        self.assertRaises(ValueError, jobq.run, range(3),
+                          [(multi2, 1, {'foo': 1})])
+        self.assertRaises(ValueError, jobq.run, range(3),
+                          [(multi2, 1, {'batch': (0, 1)})])
+
+
+class TestAutoscale(unittest.TestCase):
+
+    def test_grow(self):
+
+        def collect(args):
+            rst.append(args)
+
+        probe = {}
+        rst = []
+        t0 = time.time()
+        jobq.run(range(200), [add1, (multi2_sleep, (1, 20)), collect],
+                 probe=probe)
+        self.assertEqual(set(range(2, 402, 2)), set(rst))
+
+        # 200 * 0.02 = 4 seconds with 1 thread
+        self.assertLess(time.time() - t0, 2)
+
+        stat = jobq.stat(probe)
+        self.assertEqual(1, stat[1]['autoscale']['min'])
+        self.assertEqual(20, stat[1]['autoscale']['max'])
+        self.assertTrue(stat[1]['autoscale']['grow'] > 0)
+        self.assertTrue(stat[1]['autoscale']['last'] is not None)
+        self.assertTrue(stat[1]['threads'] <= 20)
+
+    def test_keep_order(self):
+
+        def collect(args):
+            rst.append(args)
+
+        rst = []
+        jobq.run(range(200), [add1, (multi2_sleep, (1, 10)), collect],
+                 keep_order=True)
+        self.assertEqual(list(range(2, 402, 2)), rst)
+
+    def test_shrink(self):
+
+        def slow_tail():
+            for i in range(200):
+                yield i
+            time.sleep(2)
+
+        probe = {}
+        jobq.run(slow_tail(), [(multi2_sleep, (2, 10))], probe=probe)
+
+        stat = jobq.stat(probe)
+        self.assertTrue(stat[0]['autoscale']['grow'] > 0)
+        self.assertTrue(stat[0]['autoscale']['shrink'] > 0)
+        self.assertEqual('shrink', stat[0]['autoscale']['last']['action'])
+        self.assertEqual(2, stat[0]['autoscale']['last']['threads'])
+
+    def test_invalid_range(self):
+        self.assertRaises(ValueError, jobq.run, range(3),
+                          [(multi2, (0, 2))])
+        self.assertRaises(ValueError, jobq.run, range(3),
+                          [(multi2, (3, 2))])
+
+
+class TestImap(unittest.TestCase):
+
+    def test_imap(self):
+
+        rst = jobq.imap(range(100), [add1, (multi2_sleep, 10)],
+                        keep_order=True)
+        self.assertEqual(list(range(2, 202, 2)), list(rst))
+
+        rst = jobq.imap(range(100), [add1, (multi2_sleep, 10), discard_even])
+        self.assertEqual([], list(rst))
+
+        rst = jobq.imap(range(3), [(gen_3, 2)], keep_order=True)
+        self.assertEqual([0, 1, 2] * 3, list(rst))
+
+    def test_no_worker(self):
+        self.assertEqual([0, 1, 2], list(jobq.imap(range(3), [])))
+
+    def test_bounded_buffer(self):
+
+        def count(args):
+            processed.append(args)
+            return args
+
+        processed = []
+        rst = jobq.imap(range(10000), [count], bufsize=10)
+
+        self.assertEqual(0, next(rst))
+        time.sleep(0.2)
+
+        # 1 consumed, 10 in result buffer and 1 blocked in put.
+        self.assertTrue(len(processed) <= 1 + 10 + 1,
+                        'processed: {0}'.format(len(processed)))
+
+        self.assertEqual(list(range(1, 10000)), list(rst))
+
+    def test_timeout(self):
+
+        rst = jobq.imap(range(10), [sleep_5], timeout=0.1)
+        self.assertRaises(jobq.Timeout, list, rst)
+
+        got = []
+        rst = jobq.imap(range(100), [multi2_sleep], timeout=0.3)
+        try:
+            for x in rst:
+                got.append(x)
+        except jobq.Timeout:
+            pass
+        else:
+            self.fail('imap should raise Timeout')
+
+        self.assertTrue(0 < len(got) < 100)
+
+    def test_cancel(self):
+
+        token = jobq.CancelToken()
+        threading.Timer(0.2, token.cancel).start()
+
+        rst = jobq.imap(range(100), [multi2_sleep], cancel=token)
+        self.assertRaises(jobq.Cancelled, list, rst)
+
+    def test_probe(self):
+
+        probe = {}
+        rst = jobq.imap(range(10), [multi2], probe=probe)
+        self.assertEqual(list(range(0, 20, 2)), list(rst))
+
+        stat = jobq.stat(probe)
+        self.assertEqual(1, len(stat))
+        self.assertEqual(10, stat[0]['out'])
+
+
+class TestDag(unittest.TestCase):
+
+    def test_fan_out_fan_in(self):
+
+        def collect(args):
+            with lock:
+                rst.append(args)
+
+        lock = threading.Lock()
+        rst = []
+        jobq.run_dag(range(10), [
+            {'name': 'merge', 'worker': collect, 'inputs': ['a', 'b']},
+            {'name': 'add1', 'worker': add1},
+            {'name': 'a', 'worker': (multi2, 2), 'inputs': 'add1'},
+            {'name': 'b', 'worker': (add1, 3), 'inputs': ['add1']},
+        ])
+
+        self.assertEqual(sorted(list(range(2, 22, 2)) + list(range(2, 12))),
+                         sorted(rst))
+
+    def test_hash_partition(self):
+
+        def collector(name):
+            def _collect(args):
+                with lock:
+                    rst.setdefault(name, []).append(args)
+            return _collect
+
+        lock = threading.Lock()
+        rst = {}
+        jobq.run_dag(range(100), [
+            {'name': 'p0', 'worker': collector('p0'), 'inputs': 'head'},
+            {'name': 'p1', 'worker': collector('p1'), 'inputs': 'head'},
+            {'name': 'head', 'worker': (add1, 4),
+             'route': ('hash', lambda x: x % 2)},
+        ], keep_order=True)
+
+        self.assertEqual(list(range(2, 101, 2)), rst['p0'])
+        self.assertEqual(list(range(1, 101, 2)), rst['p1'])
+
+    def test_hash_key_error(self):
+
+        def key(x):
+            if x == 100:
+                raise ValueError(x)
+            return x % 2
+
+        def collect(args):
+            with lock:
+                rst.append(args)
+
+        lock = threading.Lock()
+
+        for keep_order in (False, True):
+
+            rst = []
+            dead = []
+            probe = {}
+            summary = jobq.run_dag(range(3000), [
+                {'name': 'head',
+                 'worker': (add1, 3, {'retry': (1, 0.01),
+                                      'dead_letter': dead.append}),
+                 'route': ('hash', key)},
+                {'name': 'p0', 'worker': collect, 'inputs': 'head'},
+                {'name': 'p1', 'worker': collect, 'inputs': 'head'},
+            ], keep_order=keep_order, timeout=3, probe=probe)
+
+            self.assertEqual(False, summary['cancelled'])
+            self.assertEqual(2999, summary['completed'])
+            self.assertEqual(2999, len(rst))
+
+            stat = jobq.stat(probe)[0]
+            self.assertEqual(1, stat['error'])
+            self.assertEqual(1, stat['dead'])
+            self.assertEqual(100, dead[0][0])
+
+        # route of input_it raises the error to the caller.
+        self.assertRaises(ValueError, jobq.run_dag, range(200), [
+            {'name': 'a', 'worker': collect},
+            {'name': 'b', 'worker': collect},
+        ], route=('hash', key))
+
+    def test_input_route(self):
+
+        def collect(args):
+            with lock:
+                rst.append(args)
+
+        lock = threading.Lock()
+
+        rst = []
+        jobq.run_dag(range(10), [
+            {'name': 'a', 'worker': collect},
+            {'name': 'b', 'worker': collect},
+        ])
+        self.assertEqual(sorted(list(range(10)) * 2), sorted(rst))
+
+        rst = []
+        jobq.run_dag(range(10), [
+            {'name': 'a', 'worker': collect},
+            {'name': 'b', 'worker': collect},
+        ], route=('hash', lambda x: x))
+        self.assertEqual(list(range(10)), sorted(rst))
+
+    def test_probe(self):
+
+        probe = {}
+        jobq.run_dag(range(10), [
+            {'name': 'b', 'worker': multi2, 'inputs': 'a'},
+            {'name': 'a', 'worker': add1},
+        ], probe=probe)
+
+        stat = jobq.stat(probe)
+        self.assertEqual(['a', 'b'], [x['stage'] for x in stat])
+        self.assertEqual([10, 10], [x['in'] for x in stat])
+
+    def test_invalid(self):
+
+        cases = (
+            [{'name': 'a', 'worker': add1}, {'name': 'a', 'worker': add1}],
+            [{'name': 'a', 'worker': add1, 'inputs': 'x'}],
+            [{'name': 'a', 'worker': add1, 'inputs': 'b'},
+             {'name': 'b', 'worker': add1, 'inputs': 'a'}],
+            [{'name': 'a', 'worker': add1, 'route': 'foo'}],
+        )
+
+        for stages in cases:
+            self.assertRaises(ValueError, jobq.run_dag, range(3), stages)
+
+        self.assertRaises(ValueError, jobq.run_dag, range(3),
+                          [{'name': 'a', 'worker': add1}], route='foo')
+
+
+def all_threads_quit(probe, timeout=2):
+
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        threads = []
+        for sess in probe['sessions']:
+            threads += sess['threads']
+            if 'coor_th' in sess:
+                threads.append(sess['coor_th'])
+
+        if not any([th.is_alive() for th in threads]):
+            return True
+
+        time.sleep(0.05)
+
+    return False
+
+
+class TestCancel(unittest.TestCase):
+
+    def test_summary(self):
+
+        rst = jobq.run(range(10), [add1, discard_even])
+        self.assertEqual({'completed': 5,
+                          'pending': 0,
+                          'dropped': 0,
+                          'cancelled': False}, rst)
+
+        rst = jobq.run_dag(range(10), [
+            {'name': 'a', 'worker': add1},
+            {'name': 'b', 'worker': multi2, 'inputs': 'a'},
+            {'name': 'c', 'worker': multi2, 'inputs': 'a'},
+        ])
+        self.assertEqual(20, rst['completed'])
+
+    def test_deadline_with_blocked_input(self):
+
+        probe = {}
+        t0 = time.time()
+        rst = jobq.run(range(100000), [(multi2_sleep, 2), add1],
+                       timeout=0.3, probe=probe)
+        self.assertTrue(time.time() - t0 < 0.6)
+
+        self.assertTrue(rst['cancelled'])
+        self.assertTrue(rst['completed'] < 100)
+        self.assertTrue(rst['dropped'] > 1000)
+        self.assertTrue(rst['pending'] <= 2)
+
+        self.assertTrue(all_threads_quit(probe))
+
+    def test_cancel_token(self):
+
+        for keep_order in (False, True):
+
+            probe = {}
+            token = jobq.CancelToken()
+            threading.Timer(0.2, token.cancel).start()
+
+            t0 = time.time()
+            rst = jobq.run(range(100000),
+                           [add1, (multi2_sleep, 4), (multi2, 2)],
+                           keep_order=keep_order, cancel=token, probe=probe)
+            self.assertTrue(time.time() - t0 < 0.5)
+            self.assertTrue(rst['cancelled'])
+            self.assertTrue(token.is_cancelled())
+
+            self.assertTrue(all_threads_quit(probe))
+
+    def test_cancel_process_and_async(self):
+
+        workers = [(multi2_sleep, 2, 'process')]
+        if asyncio is not None:
+            workers.append((multi2_async, 5))
+
+        probe = {}
+        rst = jobq.run(range(1000), workers, timeout=0.3, probe=probe)
+        self.assertTrue(rst['cancelled'])
+        self.assertTrue(all_threads_quit(probe))
+
+    def test_imap_stop_iteration(self):
+
+        probe = {}
+        rst = jobq.imap(range(100000), [add1, (multi2, 2)], probe=probe,
+                        bufsize=10)
+
+        self.assertEqual(2, next(rst))
+        rst.close()
+
+        self.assertTrue(all_threads_quit(probe))
+
+    def test_imap_keeps_cancel_token(self):
+
+        token = jobq.CancelToken()
+
+        self.assertEqual([1, 2, 3], list(jobq.imap(range(3), [add1],
+                                                   cancel=token)))
+        self.assertFalse(token.is_cancelled())
+
+        # closed early, only imap is stopped.
+        rst = jobq.imap(range(100000), [add1], cancel=token, bufsize=10)
+        self.assertEqual(1, next(rst))
+        rst.close()
+        self.assertFalse(token.is_cancelled())
+
+        rst = jobq.run(range(5), [add1], cancel=token)
+        self.assertEqual(5, rst['completed'])
+        self.assertFalse(rst['cancelled'])
+
+    def test_cancel_token_reused(self):
+
+        token = jobq.CancelToken()
+
+        for _ in range(3):
+            rst = jobq.run(range(5), [add1], cancel=token, timeout=10)
+            self.assertEqual(5, rst['completed'])
+
+        # finished runs are not notified any more.
+        self.assertEqual(set(), token.listeners)
+
+        token.cancel()
+        rst = jobq.run(range(5), [add1], cancel=token)
+        self.assertTrue(rst['cancelled'])
+
+
+class Flaky(object):
+
+    # fails the first `nr_fail` calls for every element.
+
+    def __init__(self, nr_fail, sleep=0):
+        self.nr_fail = nr_fail
+        self.sleep = sleep
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, args):
+
+        time.sleep(self.sleep)
+
+        with self.lock:
+            self.calls[args] = self.calls.get(args, 0) + 1
+            nr = self.calls[args]
+
+        if nr <= self.nr_fail:
+            raise Exception('fail {0} for {1}'.format(nr, args))
+
+        return args
+
+
+class TestRetry(unittest.TestCase):
+
+    def test_retry(self):
+
+        def collect(args):
+            rst.append(args)
+
+        for n, keep_order in ((1, False), (4, False), (4, True)):
+
+            probe = {}
+            rst = []
+            jobq.run(range(50),
+                     [(Flaky(2), n, {'retry': (2, 0.01)}), collect],
+                     keep_order=keep_order, probe=probe)
+
+            if keep_order:
+                self.assertEqual(list(range(50)), rst)
+            else:
+                self.assertEqual(list(range(50)), sorted(rst))
+
+            stat = jobq.stat(probe)[0]
+            self.assertEqual(100, stat['retry'])
+            self.assertEqual(0, stat['dead'])
+            self.assertEqual(100, stat['error'])
+            self.assertEqual(0, stat['retry_waiting'])
+
+    def test_dead_letter(self):
+
+        def collect(args):
+            rst.append(args)
+
+        probe = {}
+        rst = []
+        dead = []
+        jobq.run(range(10),
+                 [(Flaky(3), 2, {'retry': (2, 0.01),
+                                 'dead_letter': dead.append}),
+                  collect],
+                 keep_order=True, probe=probe)
+
+        self.assertEqual([], rst)
+        self.assertEqual(list(range(10)), sorted([x[0] for x in dead]))
+        self.assertTrue(isinstance(dead[0][1], Exception))
+
+        stat = jobq.stat(probe)[0]
+        self.assertEqual(20, stat['retry'])
+        self.assertEqual(10, stat['dead'])
+
+    def test_dead_letter_without_retry(self):
+
+        dead = []
+        jobq.run(range(10),
+                 [(err_on_even, 1, {'dead_letter': dead.append})])
+
+        self.assertEqual([0, 2, 4, 6, 8], [x[0] for x in dead])
+
+    def test_backoff_does_not_block_thread(self):
+
+        def fail_0(args):
+            processed.append(args)
+            if args == 0 and processed.count(0) == 1:
+                raise Exception('fail 0')
+            return args
+
+        def collect(args):
+            rst.append(args)
+
+        processed = []
+        rst = []
+        t0 = time.time()
+        jobq.run(range(10), [(fail_0, 1, {'retry': (1, 0.3)}), collect])
+
+        self.assertTrue(time.time() - t0 >= 0.3)
+        self.assertEqual(list(range(10)) + [0], processed)
+        self.assertEqual(list(range(1, 10)) + [0], rst)
+
+    def test_retry_keep_order_small_window(self):
+
+        def collect(args):
+            rst.append(args)
+
+        orig = jobq.REORDER_WINDOW
+        jobq.REORDER_WINDOW = 2
+        try:
+            rst = []
+            jobq.run(range(50),
+                     [(Flaky(1), 3, {'retry': (1, 0.01)}), collect],
+                     keep_order=True)
+            self.assertEqual(list(range(50)), rst)
+        finally:
+            jobq.REORDER_WINDOW = orig
+
+    def test_retry_batch(self):
+
+        def flaky_batch(batch):
+            # the first 2 batches fail
+            calls.append(batch)
+            if len(calls) <= 2:
+                raise Exception('fail')
+            return batch
+
+        def collect(args):
+            rst.append(args)
+
+        for keep_order in (False, True):
+            calls = []
+            rst = []
+            jobq.run(range(50),
+                     [(flaky_batch, 3, {'retry': (1, 0.01),
+                                        'batch': (5, 0.01)}),
+                      collect],
+                     keep_order=keep_order)
+
+            if keep_order:
+                self.assertEqual(list(range(50)), rst)
+            else:
+                self.assertEqual(list(range(50)), sorted(rst))
+
+    @unittest.skipIf(asyncio is None, 'asyncio is not available')
+    def test_retry_async(self):
+
+        def collect(args):
+            rst.append(args)
+
+        probe = {}
+        rst = []
+        dead = []
+        jobq.run(range(10),
+                 [(err_on_even_async, 3, {'retry': (2, 0.01),
+                                          'dead_letter': dead.append}),
+                  collect],
+                 probe=probe)
+
+        self.assertEqual([1, 3, 5, 7, 9], sorted(rst))
+        self.assertEqual([0, 2, 4, 6, 8], sorted([x[0] for x in dead]))
+        self.assertEqual(10, jobq.stat(probe)[0]['retry'])
+
+    def test_cancel_with_waiting_retry(self):
+
+        probe = {}
+        t0 = time.time()
+        rst = jobq.run(range(10),
+                       [(Flaky(100), 2, {'retry': (100, 0.05)})],
+                       timeout=0.3, probe=probe)
+
+        self.assertTrue(time.time() - t0 < 0.6)
+        self.assertTrue(rst['cancelled'])
+        self.assertTrue(rst['dropped'] + rst['pending'] <= 10)
+        self.assertTrue(rst['dropped'] > 0)
+        self.assertTrue(all_threads_quit(probe))
+
+    def test_invalid_retry(self):
+        self.assertRaises(ValueError, jobq.run, range(3),
+                          [(multi2, 1, {'retry': (-1, 1)})])
+
+
+class TestChunk(unittest.TestCase):
+
+    def test_parallel(self):
+
+        # a chunk is shared by threads of a job.
+        def sleep_10ms(args):
+            time.sleep(0.01)
+
+        for chunk in (None, 16, 256):
+
+            t0 = time.time()
+            rst = jobq.run(range(256), [(sleep_10ms, 8)], chunk=chunk)
+            spent = time.time() - t0
+
+            self.assertEqual(256, rst['completed'])
+            # 2.56 seconds if only one thread works
+            self.assertTrue(spent < 1, 'chunk={0} spent={1}'.format(chunk,
+                                                                     spent))
+
+    def test_chunk(self):
+
+        def collect(args):
+            rst.append(args)
+
+        for chunk in (1, 3, 256):
+            for keep_order in (False, True):
+
+                rst = []
+                probe = {}
+                summary = jobq.run(range(1000),
+                                   [add1, (multi2, 3), gen_3, discard_even,
+                                    (multi2_batch, 2, {'batch': (7, 0.01)}),
+                                    collect],
+                                   keep_order=keep_order, probe=probe,
+                                   chunk=chunk)
+
+                self.assertEqual(1000, summary['completed'])
+                self.assertEqual([2] * 1000, rst)
+                stat = jobq.stat(probe)
+                self.assertEqual([1000, 1000, 1000, 3000, 1000, 1000, 1000],
+                                 [x['in'] for x in stat])
+                self.assertEqual([0] * 7, [x['input']['size'] for x in stat])
+
+    def test_imap_and_dag(self):
+
+        self.assertEqual([x * 2 + 2 for x in range(1000)],
+                         list(jobq.imap(range(1000), [add1, (multi2, 4)],
+                                        keep_order=True, chunk=16)))
+
+        lock = threading.Lock()
+        rst = {}
+
+        def collector(name):
+            def _collect(args):
+                with lock:
+                    rst.setdefault(name, []).append(args)
+            return _collect
+
+        jobq.run_dag(range(100), [
+            {'name': 'p0', 'worker': collector('p0'), 'inputs': 'head'},
+            {'name': 'p1', 'worker': collector('p1'), 'inputs': 'head'},
+            {'name': 'head', 'worker': (add1, 4),
+             'route': ('hash', lambda x: x % 2)},
+        ], chunk=8)
+
+        self.assertEqual(list(range(2, 101, 2)), sorted(rst['p0']))
+        self.assertEqual(list(range(1, 101, 2)), sorted(rst['p1']))
+
+    def test_retry_and_async(self):
+
+        def collect(args):
+            rst.append(args)
+
+        rst = []
+        jobq.run(range(50), [(Flaky(2), 4, {'retry': (2, 0.01)}), collect],
+                 chunk=8)
+        self.assertEqual(list(range(50)), sorted(rst))
+
+        if asyncio is None:
+            return
+
+        rst = []
+        jobq.run(range(50), [(multi2_async, 4), collect], keep_order=True,
+                 chunk=8)
+        self.assertEqual([x * 2 for x in range(50)], rst)
+
+    def test_flush(self):
+
+        def collect(args):
+            rst.append(args)
+
+        def slow_input():
+            for ii in range(3):
+                yield ii
+                time.sleep(0.2)
+                got.append(list(rst))
+
+        got = []
+        rst = []
+        jobq.run(slow_input(), [add1, collect], chunk=256)
+
+        # an element put is sent when the next one is put after
+        # CHUNK_FLUSH_INTERVAL, or when the input is exhausted. add1 sends its
+        # partial chunk at once when it waits for input.
+        self.assertEqual([[], [1, 2], [1, 2]], got)
+        self.assertEqual([1, 2, 3], rst)
+
+    def test_cancel(self):
+
+        t0 = time.time()
+        summary = jobq.run(range(10000), [(multi2_sleep, 4), add1],
+                           timeout=0.2, chunk=16)
+
+        self.assertEqual(True, summary['cancelled'])
+        self.assertTrue(summary['completed'] < 10000)
+        self.assertTrue(time.time() - t0 < 1)
+
+    def test_invalid_chunk(self):
+        for chunk in (0, -1, 1.5, '1'):
+            self.assertRaises(ValueError, jobq.run, range(3), [add1],
+                              chunk=chunk)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_submit_wait(self):
+
+        def collect(args):
+            rst.append(args)
+
+        for keep_order in (False, True):
+            for chunk in (None, 16):
+
+                rst = []
+                p = jobq.Pipeline([add1, (multi2_sleep, 4), gen_3,
+                                   discard_even, collect],
+                                  keep_order=keep_order, chunk=chunk)
+                threads = set(threading.enumerate())
+
+                for ii in range(3):
+                    del rst[:]
+                    p.submit(range(10))
+                    self.assertEqual(True, p.wait())
+                    self.assertEqual([1] * 10, rst)
+
+                # threads are reused
+                self.assertEqual(set(), set(threading.enumerate()) - threads)
+
+                stat = p.stat()
+                self.assertEqual(30, stat[0]['in'])
+                self.assertEqual(30, stat[-1]['in'])
+
+                summary = p.close()
+                self.assertEqual(30, summary['completed'])
+                self.assertEqual(False, summary['cancelled'])
+
+    def test_errors_and_retry(self):
+
+        p = jobq.Pipeline([err_on_even, (Flaky(1), 2, {'retry': (1, 0.01)})])
+        p.submit(range(10))
+        self.assertEqual(True, p.wait())
+
+        stat = p.stat()
+        self.assertEqual(5, stat[0]['error'])
+        self.assertEqual(5, stat[1]['retry'])
+        self.assertEqual(5, stat[2]['in'])
+        p.close()
+
+    def test_wait_timeout(self):
+
+        token = jobq.CancelToken()
+        p = jobq.Pipeline([sleep_5], cancel=token)
+        p.submit(range(1))
+        self.assertEqual(False, p.wait(timeout=0.1))
+
+        token.cancel()
+        self.assertEqual(True, p.close()['cancelled'])
+
+    def test_closed(self):
+
+        p = jobq.Pipeline([add1])
+        p.submit(range(3))
+        self.assertEqual(3, p.close()['completed'])
+
+        self.assertRaises(ValueError, p.submit, range(3))
+        self.assertRaises(ValueError, p.wait, 1)
+        self.assertRaises(ValueError, p.close)
+
+
+class TestRateLimit(unittest.TestCase):
+
+    def test_rate(self):
+
+        def collect(args):
+            rst.append(args)
+
+        for keep_order in (False, True):
+
+            probe = {}
+            rst = []
+            t0 = time.time()
+            jobq.run(range(11), [(multi2, 4, {'rate': 20}), collect],
+                     keep_order=keep_order, probe=probe)
+            spent = time.time() - t0
+
+            # the first one is free
+            self.assertTrue(0.45 < spent < 0.8, spent)
+            if keep_order:
+                self.assertEqual([x * 2 for x in range(11)], rst)
+
+            stat = jobq.stat(probe)[0]
+            # the rate limit is shared by threads, they wait concurrently.
+            self.assertTrue(stat['throttle_time'] > 0.5,
+                            stat['throttle_time'])
+            self.assertTrue(sum(stat['busy_time']) < 0.1)
+            self.assertEqual(0, jobq.stat(probe)[1]['throttle_time'])
+
+    def test_burst(self):
+
+        t0 = time.time()
+        jobq.run(range(10), [(multi2, 2, {'rate': (10, 5)})])
+        # 5 at once, then 10 per second.
+        self.assertTrue(0.45 < time.time() - t0 < 0.8)
+
+    def test_batch(self):
+
+        t0 = time.time()
+        jobq.run(range(20),
+                 [(multi2_batch, 1, {'batch': (10, 0.1), 'rate': (40, 10)})])
+        # a token for every item
+        self.assertTrue(0.2 < time.time() - t0 < 0.6)
+
+    def test_cancel(self):
+
+        t0 = time.time()
+        rst = jobq.run(range(10), [(multi2, 1, {'rate': 0.1})], timeout=0.3)
+        self.assertEqual(True, rst['cancelled'])
+        self.assertTrue(time.time() - t0 < 1)
+
+    def test_invalid_rate(self):
+        for rate in (0, -1, (1, 0)):
+            self.assertRaises(ValueError, jobq.run, range(3),
+                              [(add1, 1, {'rate': rate})])
+
+
+class TestPartition(unittest.TestCase):
+
+    def test_key_error(self):
+
+        def key(x):
+            if x == 100:
+                raise ValueError(x)
+            return x % 3
+
+        def collect(args):
+            with lock:
+                rst.append(args)
+
+        lock = threading.Lock()
+
+        for first in (False, True):
+
+            rst = []
+            dead = []
+            probe = {}
+            workers = [(add1, 3, {'partition_key': key,
+                                  'retry': (1, 0.01),
+                                  'dead_letter': dead.append}),
+                       collect]
+            if not first:
+                # key_func is called by the upstream thread.
+                workers = [add1] + workers
+
+            summary = jobq.run(range(3000), workers, timeout=3, probe=probe)
+
+            self.assertEqual(False, summary['cancelled'])
+            self.assertEqual(2999, len(rst))
+
+            stat = jobq.stat(probe)[-3]
+            self.assertEqual(1, stat['error'])
+            self.assertEqual(1, stat['dead'])
+            self.assertEqual(1, len(dead))
+            self.assertEqual(100, dead[0][0])
+            self.assertTrue(isinstance(dead[0][1], ValueError))
+
+    def test_order_by_key(self):
+
+        def sleep_random(args):
+            time.sleep(random.random() * 0.005)
+            return args
+
+        def collect(args):
+            with lock:
+                rst.append(args)
+
+        lock = threading.Lock()
+
+        for keep_order in (False, True):
+
+            rst = []
+            probe = {}
+            jobq.run(range(200), [(sleep_random, 4,
+                                   {'partition_key': lambda x: x % 10}),
+                                  (collect, 4)],
+                     keep_order=keep_order, probe=probe)
+
+            for key in range(10):
+                self.assertEqual(list(range(key, 200, 10)),
+                                 [x for x in rst if x % 10 == key])
+
+            stat = jobq.stat(probe)[0]
+            self.assertEqual(4, stat['threads'])
+            self.assertEqual(False, 'coordinator' in stat)
+            self.assertEqual({'size': 0, 'capa': 4096}, stat['input'])
+
+            # every thread processed some of the keys.
+            self.assertEqual(4, len(stat['busy_time']))
+
+    def test_batch_retry_and_pipeline(self):
+
+        def collect(args):
+            with lock:
+                rst.append(args)
+
+        lock = threading.Lock()
+        rst = []
+        jobq.run(range(100), [(multi2_batch, 3,
+                               {'partition_key': lambda x: x % 3,
+                                'batch': (10, 0.01)}),
+                              (Flaky(1), 2, {'partition_key': lambda x: x,
+                                             'retry': (1, 0.01)}),
+                              collect])
+        self.assertEqual([x * 2 for x in range(100)], sorted(rst))
+
+        rst = []
+        p = jobq.Pipeline([(add1, 3, {'partition_key': lambda x: x}),
+                           collect])
+        p.submit(range(10))
+        self.assertEqual(True, p.wait())
+        self.assertEqual(list(range(1, 11)), sorted(rst))
+        p.close()
+
+    def test_cancel(self):
+
+        summary = jobq.run(range(100),
+                           [(sleep_5, 2, {'partition_key': lambda x: x})],
+                           timeout=0.2)
+        self.assertEqual(True, summary['cancelled'])
+        self.assertEqual(2, summary['pending'])
+        self.assertTrue(summary['dropped'] > 0)
+
+    def test_invalid(self):
+
+        for opts in ({'partition_key': 1},
+                     {'partition_key': add1, 'executor': 'async'}):
+            self.assertRaises(ValueError, jobq.run, range(3),
+                              [(add1, 2, opts)])
+
+        self.assertRaises(ValueError, jobq.run, range(3),
+                          [(add1, (1, 2), {'partition_key': add1})])
+
+
+class TestSpill(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_spill(self):
+
+        def slow_collect(args):
+            if len(rst) == 0:
+                # wait for the upstream to fill up the window.
+                time.sleep(0.2)
+                spilled.append(jobq.stat(probe)[2]['input'])
+            rst.append(args)
+
+        for keep_order, chunk in ((False, None), (True, None), (False, 8)):
+
+            probe = {}
+            rst = []
+            spilled = []
+            jobq.run(range(1000),
+                     [(add1, 2), (multi2, 4, {'spill': (self.path, 10)}),
+                      (slow_collect, 1, {'spill': (self.path, 100)})],
+                     keep_order=keep_order, chunk=chunk, probe=probe)
+
+            expected = [(x + 1) * 2 for x in range(1000)]
+            if keep_order:
+                self.assertEqual(expected, rst)
+            else:
+                self.assertEqual(expected, sorted(rst))
+
+            # the upstream runs ahead of slow_collect without blocking.
+            self.assertTrue(spilled[0]['size'] > 900, spilled)
+            self.assertTrue(spilled[0]['capa'] <= 100, spilled)
+            self.assertTrue(spilled[0]['spilled'] > 0, spilled)
+
+            self.assertEqual(0, jobq.stat(probe)[2]['input']['spilled'])
+            self.assertEqual([], os.listdir(self.path))
+
+    def test_segment(self):
+
+        q = jobq._SpillDeque(self.path, 2)
+        size = jobq.SPILL_SEGMENT_SIZE
+        jobq.SPILL_SEGMENT_SIZE = 100
+        try:
+            for ii in range(100):
+                q.append(b'x' * 20)
+
+            self.assertEqual(100, len(q))
+            nr_files = len(os.listdir(self.path))
+            self.assertTrue(nr_files > 10)
+
+            for ii in range(50):
+                q.popleft()
+            self.assertTrue(len(os.listdir(self.path)) < nr_files)
+
+            # unpicklable element is kept in memory, in order.
+            func = lambda: 1
+            q.append(func)
+            q.append(b'y')
+            self.assertEqual(52, len(q))
+
+            for ii in range(50):
+                self.assertEqual(b'x' * 20, q.popleft())
+            self.assertTrue(func is q.popleft())
+            self.assertEqual(b'y', q.popleft())
+            self.assertEqual(0, len(q))
+
+            q.append(func)
+            q.append(func)
+            q.append(func)
+            q.close()
+            self.assertEqual({}, q.held)
+            self.assertEqual([], os.listdir(self.path))
+        finally:
+            jobq.SPILL_SEGMENT_SIZE = size
+
+    def test_unpicklable_order(self):
+
+        def collect(args):
+            if len(rst) == 0:
+                # wait for elements to be spilled.
+                time.sleep(0.1)
+            rst.append(args)
+
+        func = lambda: 1
+        rst = []
+        jobq.run([0, 1, 2, 3, func, 4, 5],
+                 [(collect, 1, {'spill': (self.path, 2)})], keep_order=True)
+
+        self.assertEqual([0, 1, 2, 3, func, 4, 5], rst)
+
+    def test_cancel(self):
+
+        summary = jobq.run(range(100), [(sleep_5, 1, {'spill': (self.path,
+                                                               10)})],
+                           timeout=0.2)
+
+        self.assertEqual(True, summary['cancelled'])
+        self.assertEqual(99, summary['dropped'])
+        for ii in range(60):
+            if os.listdir(self.path) == []:
+                break
+            time.sleep(0.1)
+        self.assertEqual([], os.listdir(self.path))
+
+    def test_invalid(self):
+
+        for spill in (os.path.join(self.path, 'not-exist'), (self.path, 0)):
+            self.assertRaises(ValueError, jobq.run, range(3),
+                              [(add1, 1, {'spill': spill})])
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.journal = os.path.join(self.path, 'journal')
+        self.interval = jobq.JOURNAL_INTERVAL
+        jobq.JOURNAL_INTERVAL = 0.05
+
+    def tearDown(self):
+        jobq.JOURNAL_INTERVAL = self.interval
+        shutil.rmtree(self.path)
+
+    def test_resume(self):
+
+        def collect(args):
+            rst.append(args)
+
+        def slow_input():
+            for ii in range(1000):
+                time.sleep(0.002)
+                yield ii
+
+        def crash(args):
+            if args >= 300:
+                # the process dies
+                token.cancel()
+                time.sleep(1)
+            return args
+
+        rst = []
+        token = jobq.CancelToken()
+        summary = jobq.run(slow_input(), [(crash, 4), collect],
+                           journal=self.journal, cancel=token)
+        self.assertEqual(True, summary['cancelled'])
+
+        with open(self.journal) as f:
+            offsets = [int(x) for x in f]
+        self.assertTrue(len(offsets) > 1, offsets)
+        self.assertEqual(sorted(offsets), offsets)
+
+        # all elements before the last checkpoint are completed.
+        done = offsets[-1]
+        self.assertTrue(0 < done <= 300, offsets)
+        self.assertEqual(set(range(done)), set(rst) & set(range(done)))
+
+        # an incomplete line is ignored
+        with open(self.journal, 'a') as f:
+            f.write('99')
+
+        rst = []
+        summary = jobq.run(range(1000), [(multi2, 4), collect],
+                           journal=self.journal, resume=True)
+        self.assertEqual(1000 - done, summary['completed'])
+        self.assertEqual([x * 2 for x in range(done, 1000)], sorted(rst))
+
+        # all done
+        rst = []
+        jobq.run(range(1000), [collect], journal=self.journal, resume=True)
+        self.assertEqual([], rst)
+
+    def test_without_resume(self):
+
+        def collect(args):
+            rst.append(args)
+
+        rst = []
+        jobq.run(range(10), [collect], journal=self.journal)
+        jobq.run_dag(range(10), [{'name': 'a', 'worker': collect}],
+                     journal=self.journal)
+        self.assertEqual(list(range(10)) * 2, rst)
+
+        with open(self.journal) as f:
+            self.assertEqual('10\n', f.read())
+
+        # no journal to resume from
+        rst = []
+        os.remove(self.journal)
+        jobq.run(range(10), [collect], journal=self.journal, resume=True)
+        self.assertEqual(list(range(10)), rst)
+
+        self.assertRaises(ValueError, jobq.run, range(3), [add1],
+                          resume=True)
+
+    def test_bad_journal(self):
+
+        journal = os.path.join(self.path, 'nonexistent', 'journal')
+        nr_threads = threading.active_count()
+        nr_procs = len(multiprocessing.active_children())
+
+        self.assertRaises(IOError, jobq.run, range(3), [add1, (multi2, 4)],
+                          journal=journal)
+        self.assertRaises(IOError, jobq.run_dag, range(3),
+                          [{'name': 'a', 'worker': (multi2, 2, 'process')}],
+                          journal=journal)
+
+        # no thread or process is started.
+        self.assertEqual(nr_threads, threading.active_count())
+        self.assertEqual(nr_procs, len(multiprocessing.active_children()))
+
+
+def slow_range(n, interval=0.1):
+    for ii in range(n):
+        time.sleep(interval)
+        yield ii
+
+
+class TestInput(unittest.TestCase):
+
+    def test_merge(self):
+
+        def collect(args):
+            with lock:
+                rst.append(args)
+
+        lock = threading.Lock()
+
+        for run in (jobq.run, jobq.run_dag):
+
+            rst = []
+            t0 = time.time()
+            inputs = jobq.Merge(slow_range(5), slow_range(5), slow_range(5))
+            if run is jobq.run:
+                jobq.run(inputs, [collect])
+            else:
+                jobq.run_dag(inputs, [{'name': 'a', 'worker': collect}])
+
+            # iterators are read concurrently
+            self.assertTrue(time.time() - t0 < 1.0)
+            self.assertEqual(sorted(list(range(5)) * 3), sorted(rst))
+
+        self.assertEqual([1, 1, 2, 2],
+                         sorted(jobq.imap(jobq.Merge(range(2), range(2)),
+                                          [add1])))
+
+        rst = []
+        p = jobq.Pipeline([collect])
+        p.submit(jobq.Merge(range(2), range(3)))
+        p.wait()
+        self.assertEqual([0, 0, 1, 1, 2], sorted(rst))
+        p.close()
+
+    def test_prefetch(self):
+
+        probe = {}
+        jobq.run(range(10), [add1], prefetch=10, probe=probe)
+        self.assertEqual(10, jobq.stat(probe)[0]['input']['capa'])
+
+        for prefetch in (0, None, 1.5):
+            self.assertRaises(ValueError, jobq.run, range(3), [add1],
+                              prefetch=prefetch)
+
+    def test_blocking_input_timeout(self):
+
+        # the caller returns at timeout even if input_it is blocking.
+        t0 = time.time()
+        rst = jobq.run(slow_range(3, interval=2), [add1], timeout=0.2)
+        self.assertTrue(time.time() - t0 < 0.5)
+        self.assertEqual(True, rst['cancelled'])
+
+    def test_input_error(self):
+
+        def bad_input():
+            for ii in range(5):
+                yield ii
+            raise ValueError('bad input')
+
+        def collect(args):
+            rst.append(args)
+
+        rst = []
+        self.assertRaises(ValueError, jobq.run, bad_input(), [collect])
+        # elements read are processed
+        self.assertEqual(list(range(5)), rst)
+
+        self.assertRaises(ValueError, list, jobq.imap(bad_input(), [add1]))
+
+        p = jobq.Pipeline([add1])
+        self.assertRaises(ValueError, p.submit, bad_input())
+        p.submit(range(3))
+        self.assertEqual(True, p.wait())
+        p.close()
+
+        self.assertRaises(ValueError, jobq.run, jobq.Merge(range(3)), [add1],
+                          journal='/tmp/jobq-journal')
+
+
+class TestFuse(unittest.TestCase):
+
+    def test_fuse(self):
+
+        def collect(args):
+            rst.append(args)
+
+        for keep_order in (False, True):
+
+            rst = []
+            probe = {}
+            summary = jobq.run(range(100),
+                               [add1, gen_3, err_on_even, discard_even,
+                                (multi2, 2), add1, collect],
+                               keep_order=keep_order, fuse=True, probe=probe)
+
+            self.assertEqual([3] * 100, rst)
+            self.assertEqual(100, summary['completed'])
+
+            stat = jobq.stat(probe)
+            self.assertEqual([1, 0, 0, 0, 2, 1, 0, 0],
+                             [x['threads'] for x in stat])
+            self.assertEqual(['None', 'add1', 'add1', 'add1', 'None', 'None',
+                              'add1', 'add1'],
+                             [x.get('fused_into', ':None').split(':')[1]
+                              for x in stat])
+
+            # every stage reports its own stat
+            self.assertEqual([100, 100, 300, 100, 100, 100, 100, 100],
+                             [x['in'] for x in stat])
+            self.assertEqual([100, 300, 100, 100, 100, 100, 100, 0],
+                             [x['out'] for x in stat])
+            self.assertEqual([0, 0, 200, 0, 0, 0, 0, 0],
+                             [x['error'] for x in stat])
+
+    def test_not_fused(self):
+
+        probe = {}
+        jobq.run(range(10), [add1, (multi2_batch, 1, {'batch': (2, 0.1)}),
+                             (add1, 1, 'process'), (add1, (1, 2))],
+                 fuse=True, probe=probe)
+
+        self.assertEqual([False] * 5,
+                         ['fused_into' in x for x in jobq.stat(probe)])
+
+    def test_imap_and_pipeline(self):
+
+        self.assertEqual([x * 2 + 2 for x in range(10)],
+                         list(jobq.imap(range(10), [add1, multi2],
+                                        fuse=True)))
+
+        p = jobq.Pipeline([add1, multi2], fuse=True)
+        p.submit(range(10))
+        self.assertEqual(True, p.wait())
+        self.assertEqual(1, len([x for x in p.stat() if x['threads'] == 1]))
+        p.close()
+
+
+class TestCache(unittest.TestCase):
+
+    def test_cache(self):
+
+        def slow_multi2(args):
+            with lock:
+                calls.append(args)
+            time.sleep(0.01)
+            return args * 2
+
+        def collect(args):
+            rst.append(args)
+
+        lock = threading.Lock()
+
+        for keep_order in (False, True):
+
+            calls = []
+            rst = []
+            probe = {}
+            jobq.run([x % 10 for x in range(100)],
+                     [(slow_multi2, 4, {'cache': 100}), collect],
+                     keep_order=keep_order, probe=probe)
+
+            # identical elements in flight are called only once.
+            self.assertEqual(list(range(10)), sorted(calls))
+            expected = [x % 10 * 2 for x in range(100)]
+            if keep_order:
+                self.assertEqual(expected, rst)
+            else:
+                self.assertEqual(sorted(expected), sorted(rst))
+
+            stat = jobq.stat(probe)[0]['cache']
+            self.assertEqual(10, stat['size'])
+            self.assertEqual(100, stat['capa'])
+            self.assertEqual(90, stat['hit'])
+            self.assertEqual(10, stat['miss'])
+            self.assertEqual(0.9, stat['hit_ratio'])
+
+    def test_lru_ttl_key(self):
+
+        def count(args):
+            calls.append(args)
+            return args
+
+        calls = []
+        jobq.run([1, 2, 3, 1, 3, 2], [(count, 1, {'cache': 2})])
+        # 1 is evicted by 3, then 2 is evicted by 1
+        self.assertEqual([1, 2, 3, 1, 2], calls)
+
+        calls = []
+
+        def slow_input():
+            yield 1
+            yield 1
+            time.sleep(0.1)
+            yield 1
+
+        jobq.run(slow_input(), [(count, 1, {'cache': (10, 0.05)})])
+        self.assertEqual([1, 1], calls)
+
+        calls = []
+        jobq.run(['a', 'A', 'b', [1], [1]],
+                 [(count, 1, {'cache': (10, None, lambda x: str(x).lower())})])
+        self.assertEqual(['a', 'b', [1]], calls)
+
+    def test_generator_and_error(self):
+
+        def collect(args):
+            rst.append(args)
+
+        rst = []
+        probe = {}
+        jobq.run([1, 1, 2, 2], [(gen_3, 1, {'cache': 10}), collect],
+                 probe=probe)
+        self.assertEqual([0, 1, 2] * 4, rst)
+        self.assertEqual(2, jobq.stat(probe)[0]['cache']['hit'])
+
+        # errors are not cached
+        probe = {}
+        jobq.run([0, 0, 1], [(err_on_even, 1, {'cache': 10})], probe=probe)
+        stat = jobq.stat(probe)[0]
+        self.assertEqual(2, stat['error'])
+        self.assertEqual(0, stat['cache']['hit'])
+
+    def test_invalid(self):
+        for opts in ({'cache': 0}, {'cache': (10, 0)},
+                     {'cache': 10, 'batch': (2, 0.1)}):
+            self.assertRaises(ValueError, jobq.run, range(3),
+                              [(add1, 1, opts)])
+
+
 class TestDefaultTimeout(unittest.TestCase):
 
     def test_default_timeout_is_not_too_large(self):
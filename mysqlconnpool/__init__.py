@@ -1,5 +1,6 @@
 # from .mysqlconnpool import (MysqlConnectionPool,)
 from .mysqlconnpool import (
+    PoolTimeout,
     make,
     conn_query,
 )
@@ -1,25 +1,138 @@
 #!/usr/bin/env python2
 # coding: utf-8
 
+import bisect
 import copy
 import logging
 import Queue
+import threading
+import time
+import weakref
 
 import MySQLdb
 
 logger = logging.getLogger(__name__)
 
+# how often the background thread checks idle connections and opens new
+# ones, if only `min_size` is specified.
+MAINTAIN_INTERVAL = 1.0
+
+# upper bounds of latency histogram buckets in seconds, from 10 us to about
+# 160 seconds, 4 buckets for every power of 2.
+LATENCY_BOUNDS = [1e-5 * 2 ** (x / 4.0) for x in range(4 * 24)]
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class Histogram(object):
+
+    # not thread safe, it is updated with pool lock held.
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, val):
+        self.buckets[bisect.bisect_left(LATENCY_BOUNDS, val)] += 1
+        self.count += 1
+        self.sum += val
+        self.max = max(self.max, val)
+
+    def percentile(self, q):
+
+        if self.count == 0:
+            return None
+
+        acc = 0
+        for ii, cnt in enumerate(self.buckets):
+            acc += cnt
+            if acc >= self.count * q:
+                break
+
+        if ii == len(LATENCY_BOUNDS):
+            return self.max
+
+        return LATENCY_BOUNDS[ii]
+
+    def stat(self):
+
+        avg = None
+        if self.count > 0:
+            avg = self.sum / self.count
+
+        # (upper bound, count) of non-empty buckets. The last bound is None
+        # for values greater than any bound.
+        bounds = LATENCY_BOUNDS + [None]
+        buckets = [(bounds[ii], cnt)
+                   for ii, cnt in enumerate(self.buckets)
+                   if cnt > 0]
+
+        return {'count': self.count,
+                'avg': avg,
+                'max': self.max,
+                'p50': self.percentile(0.5),
+                'p90': self.percentile(0.9),
+                'p99': self.percentile(0.99),
+                'buckets': buckets,
+                }
+
 
 class MysqlConnectionPool(object):
 
-    def __init__(self, conn_argkw, options=None):
+    def __init__(self, conn_argkw, options=None, max_size=None, idle_size=32,
+                 timeout=None, ping_idle=None, max_idle=None,
+                 max_lifetime=None, min_size=0):
 
         options = options or {}
         options = copy.deepcopy(options)
 
+        if max_size is not None and max_size < 1:
+            raise ValueError('invalid max_size: ' + repr(max_size))
+
+        if (min_size < 0
+                or min_size > idle_size
+                or (max_size is not None and min_size > max_size)):
+            raise ValueError('invalid min_size: ' + repr(min_size))
+
+        for k, v in (('ping_idle', ping_idle),
+                     ('max_idle', max_idle),
+                     ('max_lifetime', max_lifetime)):
+            if v is not None and v < 0:
+                raise ValueError('invalid {k}: {v}'.format(k=k, v=repr(v)))
+
         self.options = options
-        self.queue = Queue.Queue(32)
+        # at most `idle_size` connections are kept in pool when they are
+        # not used.
+        # Elements are (conn, idle_since). The last put back is reused
+        # first, thus connections at the bottom stay idle and are evicted.
+        self.queue = Queue.LifoQueue(idle_size)
         self.conn_argkw = conn_argkw
+
+        # a connection idle for more than `ping_idle` seconds is pinged
+        # before being returned.
+        # a connection idle for more than `max_idle` seconds, or opened for
+        # more than `max_lifetime` seconds is closed.
+        self.ping_idle = ping_idle
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+
+        # at least `min_size` connections are kept open.
+        self.min_size = min_size
+
+        # id(conn) to the time it is created
+        self.created = {}
+
+        # at most `max_size` connections are open, including those in use.
+        # get_conn() waits for one to be put back, for at most `timeout`
+        # seconds.
+        self.max_size = max_size
+        self.timeout = timeout
+        self.size = 0
+        self.cond = threading.Condition()
         if 'host' in conn_argkw:
             self.name = '{host}:{port}'.format(**conn_argkw)
         else:
@@ -29,34 +142,313 @@ class MysqlConnectionPool(object):
                      'create': 0,
                      'pool_get': 0,
                      'pool_put': 0,
+                     'close': 0,
+                     'wait': 0,
+                     'wait_timeout': 0,
+                     'ping': 0,
+                     'ping_fail': 0,
+                     'evict_idle': 0,
+                     'evict_lifetime': 0,
                      }
 
+        # seconds spent getting a connection, using a connection, opening a
+        # connection and running pool.query().
+        self.hists = {'wait_time': Histogram(),
+                      'hold_time': Histogram(),
+                      'connect_time': Histogram(),
+                      'query_time': Histogram(),
+                      }
+
+        intervals = [x / 2.0 for x in (max_idle, max_lifetime)
+                     if x is not None]
+        if min_size > 0:
+            intervals.append(MAINTAIN_INTERVAL)
+
+        self.fill()
+
+        if len(intervals) > 0:
+            start_maintainer(self, max(min(intervals), 0.01))
+
+    def get_stat(self):
+
+        with self.cond:
+            stat = dict(self.stat)
+            for k, hist in self.hists.items():
+                stat[k] = hist.stat()
+
+        return stat
+
+    def observe(self, key, spent):
+        with self.cond:
+            self.hists[key].add(spent)
+
     def get_conn(self):
 
-        try:
-            conn = self.queue.get(block=False)
-            self.stat['pool_get'] += 1
-            logger.debug('reuse connection:' + repr(self.stat))
+        t0 = time.time()
+        conn = self._get_conn()
+        self.observe('wait_time', time.time() - t0)
+
+        return conn
+
+    def _get_conn(self):
+
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+
+        while True:
+
+            idle = self._get_idle(deadline)
+            if idle is None:
+                break
+
+            conn, idle_since = idle
+            if not self._check(conn, idle_since):
+                continue
+
+            with self.cond:
+                self.stat['pool_get'] += 1
+                logger.debug('reuse connection:' + repr(self.stat))
             return conn
 
-        except Queue.Empty:
+        return self._connect()
+
+    def _connect(self):
+
+        # the room must have been taken.
 
+        t0 = time.time()
+        try:
             conn = new_connection(self.conn_argkw, options=self.options)
+        except Exception:
+            self._release_room()
+            raise
 
+        with self.cond:
+            self.hists['connect_time'].add(time.time() - t0)
+            self.created[id(conn)] = time.time()
             self.stat['create'] += 1
             logger.info('create new connection: ' + repr(self.stat))
 
-            return conn
+        return conn
 
-    def put_conn(self, conn):
+    def fill(self):
+
+        # open connections in parallel until there are `min_size` of them.
+
+        with self.cond:
+            n = self.min_size - self.size
+            if n <= 0:
+                return 0
+            self.size += n
+
+        ths = [threading.Thread(target=self._fill_one) for ii in range(n)]
+        for th in ths:
+            th.daemon = True
+            th.start()
+
+        for th in ths:
+            th.join()
+
+        return n
+
+    def _fill_one(self):
 
         try:
-            self.queue.put(conn, block=False)
-            self.stat['pool_put'] += 1
-            logger.debug('put connection:' + repr(self.stat))
+            conn = self._connect()
+        except Exception as e:
+            # the next get_conn() tries again and raises the error.
+            logger.warn('failed to open connection: ' + repr(e))
+            return
+
+        with self.cond:
+            try:
+                self.queue.put((conn, time.time()), block=False)
+                self.cond.notify()
+                return
+            except Queue.Full:
+                pass
+
+        self.close_conn(conn)
+
+    def _get_idle(self, deadline):
+
+        # returns an idle (conn, idle_since), or None if there is room to
+        # create a new connection.
+
+        waited = False
+
+        with self.cond:
+
+            while True:
+
+                try:
+                    return self.queue.get(block=False)
+                except Queue.Empty:
+                    pass
+
+                if self.max_size is None or self.size < self.max_size:
+                    # take the room before connecting without lock.
+                    self.size += 1
+                    return None
+
+                if not waited:
+                    waited = True
+                    self.stat['wait'] += 1
+
+                if deadline is None:
+                    self.cond.wait()
+                    continue
+
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    self.stat['wait_timeout'] += 1
+                    raise PoolTimeout(
+                        'no connection in {t} seconds: {s}'.format(
+                            t=self.timeout, s=repr(self.stat)))
+
+                self.cond.wait(timeout)
+
+    def _check(self, conn, idle_since):
+
+        # close an idle connection if it is too old or broken.
 
-        except Queue.Full:
+        now = time.time()
+
+        if self._expired(conn, now):
+            self._discard(conn, 'evict_lifetime')
+            return False
+
+        if self.ping_idle is None or now - idle_since < self.ping_idle:
+            return True
+
+        try:
+            conn.ping()
+        except MySQLdb.Error as e:
+            logger.info('ping failed: {e} {s}'.format(e=repr(e),
+                                                      s=repr(self.stat)))
+            self._discard(conn, 'ping_fail')
+            return False
+
+        with self.cond:
+            self.stat['ping'] += 1
+
+        return True
+
+    def _expired(self, conn, now):
+
+        if self.max_lifetime is None:
+            return False
+
+        created = self.created.get(id(conn), now)
+        return now - created >= self.max_lifetime
+
+    def evict(self):
+
+        # close idle connections that are idle or opened for too long.
+
+        now = time.time()
+        evicted = []
+
+        with self.cond:
+
+            # idle connections are not evicted if there would be less than
+            # `min_size` connections.
+            nr_evictable = self.size - self.min_size
+
+            keep = []
+            for conn, idle_since in self.queue.queue:
+
+                if self._expired(conn, now):
+                    evicted.append((conn, 'evict_lifetime'))
+                elif (self.max_idle is not None
+                      and now - idle_since >= self.max_idle
+                      and len(evicted) < nr_evictable):
+                    evicted.append((conn, 'evict_idle'))
+                else:
+                    keep.append((conn, idle_since))
+
+            self.queue.queue[:] = keep
+
+        for conn, reason in evicted:
+            self._discard(conn, reason)
+
+        return len(evicted)
+
+    def put_conn(self, conn):
+
+        if self._expired(conn, time.time()):
+            self._discard(conn, 'evict_lifetime')
+            return
+
+        with self.cond:
+            try:
+                self.queue.put((conn, time.time()), block=False)
+                self.stat['pool_put'] += 1
+                logger.debug('put connection:' + repr(self.stat))
+                self.cond.notify()
+                return
+
+            except Queue.Full:
+                pass
+
+        self.close_conn(conn)
+
+    def close_conn(self, conn):
+
+        # close a connection that is not going to be put back.
+        self._discard(conn, 'close')
+
+    def _discard(self, conn, reason):
+
+        try:
             conn.close()
+        except MySQLdb.Error as e:
+            # the connection is already broken.
+            logger.info('close connection: ' + repr(e))
+        finally:
+            with self.cond:
+                self.created.pop(id(conn), None)
+                self.stat[reason] += 1
+            self._release_room()
+
+    def _release_room(self):
+        # a thread waiting for connection can create one.
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+
+
+def start_maintainer(pool, interval):
+
+    # the thread does not keep pool alive, it quits after pool is gone.
+    pool_ref = weakref.ref(pool)
+
+    def _maintain_loop():
+
+        while True:
+
+            time.sleep(interval)
+
+            pool = pool_ref()
+            if pool is None:
+                return
+
+            try:
+                pool.evict()
+                # replace closed connections.
+                pool.fill()
+            except Exception as e:
+                logger.exception('maintain connections: ' + repr(e))
+
+            del pool
+
+    th = threading.Thread(target=_maintain_loop,
+                          name='mysqlconnpool-maintainer')
+    th.daemon = True
+    th.start()
+
+    return th
 
 
 class ConnectionWrapper(object):
@@ -64,34 +456,47 @@ class ConnectionWrapper(object):
     def __init__(self, pool):
         self.pool = pool
         self.conn = None
+        self.t0 = None
 
     def __enter__(self):
         self.conn = self.pool.get_conn()
+        self.t0 = time.time()
         return self.conn
 
     def __exit__(self, errtype, errval, _traceback):
 
+        self.pool.observe('hold_time', time.time() - self.t0)
+
         if errtype is None:
             self.pool.put_conn(self.conn)
-            self.conn = None
         else:
-            self.conn.close()
+            self.pool.close_conn(self.conn)
+
+        self.conn = None
 
 
-def make(conn_argkw, options=None):
+def make(conn_argkw, options=None, max_size=None, idle_size=32,
+         timeout=None, ping_idle=None, max_idle=None, max_lifetime=None,
+         min_size=0):
 
-    pool = MysqlConnectionPool(conn_argkw, options=options)
+    pool = MysqlConnectionPool(conn_argkw, options=options,
+                               max_size=max_size, idle_size=idle_size,
+                               timeout=timeout, ping_idle=ping_idle,
+                               max_idle=max_idle, max_lifetime=max_lifetime,
+                               min_size=min_size)
 
     def pool_api(action=None):
 
         if action is None or action == 'get_conn':
             return ConnectionWrapper(pool)
         elif action == 'stat':
-            return pool.stat
+            return pool.get_stat()
         else:
             raise ValueError(action, 'invalid action: ' + repr(action))
 
     pool_api.query = lambda *args, **kwargs: query(pool_api, *args, **kwargs)
+    pool_api.query_iter = lambda *args, **kwargs: query_iter(pool_api, *args,
+                                                             **kwargs)
 
     return pool_api
 
@@ -112,8 +517,55 @@ def conn_query(conn, sql, use_dict=True):
 
 def query(pool, sql, use_dict=True):
 
+    wrapper = pool()
+    with wrapper as conn:
+
+        t0 = time.time()
+        rst = conn_query(conn, sql, use_dict=use_dict)
+        wrapper.pool.observe('query_time', time.time() - t0)
+
+        return rst
+
+
+def query_iter(pool, sql, use_dict=True, batch=None):
+
+    if batch is not None and batch < 1:
+        raise ValueError('invalid batch: ' + repr(batch))
+
+    return _query_iter(pool, sql, use_dict, batch)
+
+
+def _query_iter(pool, sql, use_dict, batch):
+
+    # Rows are read from server with an unbuffered cursor while being
+    # iterated.
+    # The connection is put back after all rows are read. If the iteration
+    # stops early, the connection is closed to discard unread rows.
+
     with pool() as conn:
-        return conn_query(conn, sql, use_dict=use_dict)
+
+        if use_dict:
+            cur = conn.cursor(MySQLdb.cursors.SSDictCursor)
+        else:
+            cur = conn.cursor(MySQLdb.cursors.SSCursor)
+
+        cur.execute(sql)
+
+        while True:
+
+            if batch is None:
+                row = cur.fetchone()
+                if row is None:
+                    break
+                yield row
+
+            else:
+                rows = cur.fetchmany(batch)
+                if len(rows) == 0:
+                    break
+                yield rows
+
+        cur.close()
 
 
 def new_connection(conn_argkw, conv=None, options=None):
@@ -130,7 +582,9 @@ def new_connection(conn_argkw, conv=None, options=None):
     opt.update(options)
 
     conn = MySQLdb.connect(conv=conv, **conn_argkw)
-    for k, v in opt.items():
-        conn.query('set {k}={v}'.format(k=k, v=v))
+
+    # set all options in one round trip.
+    conn.query('set ' + ', '.join(['{k}={v}'.format(k=k, v=v)
+                                   for k, v in sorted(opt.items())]))
 
     return conn
@@ -3,6 +3,7 @@
 
 import socket
 import subprocess
+import threading
 import time
 import unittest
 
@@ -46,12 +47,13 @@ class Testmysqlconnpool(unittest.TestCase):
         else:
             raise
 
-        self.pool = mysqlconnpool.make({
+        self.conn_argkw = {
             'host': self.mysql_ip,
             'port': mysql_test_port,
             'user': mysql_test_user,
             'passwd': mysql_test_password,
-        })
+        }
+        self.pool = mysqlconnpool.make(self.conn_argkw)
 
     def tearDown(self):
         stop_mysql_server()
@@ -180,6 +182,314 @@ class Testmysqlconnpool(unittest.TestCase):
         databases = [x[0] for x in rst]
         self.assertTrue('mysql' in databases)
 
+    def test_max_size_timeout(self):
+
+        pool = mysqlconnpool.make(self.conn_argkw, max_size=2, timeout=0.5)
+
+        with pool():
+            with pool():
+
+                t0 = time.time()
+                self.assertRaises(mysqlconnpool.PoolTimeout, pool().__enter__)
+                self.assertTrue(0.4 < time.time() - t0 < 1)
+
+        dd('pool stat: {0}'.format(pool('stat')))
+
+        self.assertEqual(2, pool('stat')['create'])
+        self.assertEqual(1, pool('stat')['wait'])
+        self.assertEqual(1, pool('stat')['wait_timeout'])
+
+    def test_max_size_wait_for_put_back(self):
+
+        pool = mysqlconnpool.make(self.conn_argkw, max_size=1)
+
+        def put_back_later(wrapper):
+            time.sleep(0.2)
+            wrapper.__exit__(None, None, None)
+
+        wrapper = pool()
+        c0 = wrapper.__enter__()
+
+        th = threading.Thread(target=put_back_later, args=(wrapper, ))
+        th.start()
+
+        t0 = time.time()
+        with pool() as conn:
+            self.assertTrue(time.time() - t0 > 0.1)
+            self.assertTrue(c0 is conn)
+
+        th.join()
+
+        # a connection closed for error makes room for a new one.
+        try:
+            with pool() as conn:
+                raise ValueError(1)
+        except ValueError:
+            pass
+
+        with pool() as conn:
+            self.assertFalse(c0 is conn)
+
+        self.assertEqual(2, pool('stat')['create'])
+        self.assertEqual(1, pool('stat')['close'])
+
+    def test_concurrent_max_size(self):
+
+        pool = mysqlconnpool.make(self.conn_argkw, max_size=3)
+        lock = threading.Lock()
+        in_use = [0, 0]
+
+        def _query():
+            for ii in range(20):
+                with pool() as conn:
+                    with lock:
+                        in_use[0] += 1
+                        in_use[1] = max(in_use)
+                    conn.query('select 1')
+                    conn.store_result()
+                    with lock:
+                        in_use[0] -= 1
+
+        ths = [threading.Thread(target=_query) for ii in range(10)]
+        for th in ths:
+            th.start()
+        for th in ths:
+            th.join()
+
+        self.assertEqual(3, in_use[1])
+        self.assertEqual(3, pool('stat')['create'])
+
+    def test_idle_size(self):
+
+        pool = mysqlconnpool.make(self.conn_argkw, idle_size=1)
+
+        with pool():
+            with pool():
+                pass
+
+        # only one is kept in pool, the other is closed.
+        self.assertEqual(2, pool('stat')['create'])
+        self.assertEqual(1, pool('stat')['pool_put'])
+        self.assertEqual(1, pool('stat')['close'])
+
+    def test_ping_idle(self):
+
+        pool = mysqlconnpool.make(self.conn_argkw, ping_idle=0.1)
+
+        with pool() as c0:
+            conn_id = mysqlconnpool.conn_query(
+                c0, 'select connection_id() as id')[0]['id']
+
+        # kill the idle connection in pool, as what mysql wait_timeout does.
+        with mysqlconnpool.make(self.conn_argkw)() as killer:
+            killer.query('kill {0}'.format(conn_id))
+
+        time.sleep(0.2)
+
+        with pool() as conn:
+            self.assertFalse(c0 is conn)
+            conn.query('select 1')
+            conn.store_result()
+
+        dd('pool stat: {0}'.format(pool('stat')))
+
+        self.assertEqual(2, pool('stat')['create'])
+        self.assertEqual(1, pool('stat')['ping_fail'])
+
+        # a connection just used is not pinged.
+        with pool():
+            pass
+
+        self.assertEqual(0, pool('stat')['ping'])
+
+    def test_max_idle(self):
+
+        pool = mysqlconnpool.make(self.conn_argkw, max_idle=0.2)
+
+        with pool() as c0:
+            pass
+
+        with pool() as conn:
+            self.assertTrue(c0 is conn)
+
+        time.sleep(0.5)
+
+        self.assertEqual(1, pool('stat')['evict_idle'])
+
+        with pool() as conn:
+            self.assertFalse(c0 is conn)
+
+        self.assertEqual(2, pool('stat')['create'])
+
+    def test_max_lifetime(self):
+
+        pool = mysqlconnpool.make(self.conn_argkw, max_lifetime=0.5)
+
+        with pool() as c0:
+            # in use connection is not closed.
+            time.sleep(0.6)
+
+        self.assertEqual(1, pool('stat')['evict_lifetime'])
+
+        with pool() as conn:
+            self.assertFalse(c0 is conn)
+
+        self.assertEqual(0, pool('stat')['pool_get'])
+        self.assertEqual(2, pool('stat')['create'])
+
+    def test_min_size(self):
+
+        pool = mysqlconnpool.make(self.conn_argkw, min_size=3, max_idle=0.1)
+
+        self.assertEqual(3, pool('stat')['create'])
+
+        with pool():
+            with pool():
+                with pool():
+                    with pool():
+                        pass
+
+        self.assertEqual(3, pool('stat')['pool_get'])
+        self.assertEqual(4, pool('stat')['create'])
+
+        # idle connections are evicted but `min_size` are kept.
+        time.sleep(0.5)
+
+        self.assertEqual(1, pool('stat')['evict_idle'])
+        self.assertEqual(4, pool('stat')['create'])
+
+        # closed connection is replaced in background.
+        try:
+            with pool():
+                raise ValueError(1)
+        except ValueError:
+            pass
+
+        time.sleep(1.5)
+        self.assertEqual(5, pool('stat')['create'])
+
+        self.assertRaises(ValueError, mysqlconnpool.make, self.conn_argkw,
+                          min_size=3, max_size=2)
+
+    def test_options_in_one_query(self):
+
+        pool = mysqlconnpool.make(self.conn_argkw,
+                                  options={'sql_mode': "'STRICT_ALL_TABLES'",
+                                           'wait_timeout': 100})
+
+        rst = pool.query('select @@session.sql_mode as m,'
+                         ' @@session.wait_timeout as w,'
+                         ' @@session.autocommit as a')
+
+        self.assertEqual([{'m': 'STRICT_ALL_TABLES', 'w': 100, 'a': 1}],
+                         [dict(x) for x in rst])
+
+    def test_stat_histogram(self):
+
+        pool = mysqlconnpool.make(self.conn_argkw, max_size=2)
+
+        def _query():
+            for ii in range(10):
+                with pool() as conn:
+                    time.sleep(0.01)
+                pool.query('select 1')
+
+        ths = [threading.Thread(target=_query) for ii in range(4)]
+        for th in ths:
+            th.start()
+        for th in ths:
+            th.join()
+
+        stat = pool('stat')
+        dd('pool stat: {0}'.format(stat))
+
+        # counters are not lost under concurrency.
+        self.assertEqual(80, stat['create'] + stat['pool_get'])
+        self.assertEqual(80, stat['pool_put'])
+
+        self.assertEqual(80, stat['wait_time']['count'])
+        self.assertEqual(80, stat['hold_time']['count'])
+        self.assertEqual(2, stat['connect_time']['count'])
+        self.assertEqual(40, stat['query_time']['count'])
+
+        self.assertTrue(stat['hold_time']['max'] >= 0.01)
+        self.assertTrue(stat['wait'] > 0)
+        self.assertTrue(stat['wait_time']['max'] > 0)
+
+        for k in ('wait_time', 'hold_time', 'connect_time', 'query_time'):
+            hist = stat[k]
+            self.assertTrue(hist['p50'] <= hist['p90'] <= hist['p99'])
+            self.assertEqual(hist['count'],
+                             sum([cnt for _, cnt in hist['buckets']]))
+
+        # stat is a snapshot
+        stat['create'] = -1
+        self.assertEqual(2, pool('stat')['create'])
+
+    def test_initial_stat_histogram(self):
+
+        hist = self.pool('stat')['wait_time']
+
+        self.assertEqual({'count': 0,
+                          'avg': None,
+                          'max': 0.0,
+                          'p50': None,
+                          'p90': None,
+                          'p99': None,
+                          'buckets': [],
+                          }, hist)
+
+    def test_query_iter(self):
+
+        pool = self.pool
+        sql = 'select user, host from mysql.user'
+
+        expected = pool.query(sql)
+        self.assertTrue(len(expected) > 0)
+
+        rst = list(pool.query_iter(sql))
+        self.assertEqual(list(expected), rst)
+
+        rst = list(pool.query_iter(sql, use_dict=False))
+        self.assertEqual([(x['user'], x['host']) for x in expected], rst)
+
+        rst = list(pool.query_iter(sql, batch=2))
+        self.assertTrue(all([0 < len(x) <= 2 for x in rst]))
+        self.assertEqual(list(expected), sum([list(x) for x in rst], []))
+
+        dd('pool stat: {0}'.format(pool('stat')))
+
+        # connection is reused.
+        self.assertEqual(1, pool('stat')['create'])
+        self.assertEqual(0, pool('stat')['close'])
+
+        self.assertRaises(ValueError, pool.query_iter, sql, batch=0)
+
+    def test_query_iter_connection(self):
+
+        pool = self.pool
+        sql = 'select user, host from mysql.user'
+
+        it = pool.query_iter(sql)
+
+        # connection is not taken before iteration.
+        self.assertEqual(0, pool('stat')['create'])
+
+        next(it)
+        self.assertEqual(1, pool('stat')['create'])
+        self.assertEqual(0, pool('stat')['pool_put'])
+
+        # not put back until closed, unread rows are discarded by closing
+        # the connection.
+        it.close()
+        self.assertEqual(0, pool('stat')['pool_put'])
+        self.assertEqual(1, pool('stat')['close'])
+
+        # error closes the connection.
+        it = pool.query_iter('select * from no_such_table')
+        self.assertRaises(Exception, next, it)
+        self.assertEqual(2, pool('stat')['close'])
+
 
 def start_mysql_server():
 